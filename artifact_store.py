@@ -0,0 +1,99 @@
+import hashlib
+import os
+import shutil
+
+STORE_DIR = ".cache/store"
+
+
+def link_file(source, destination):
+    """Hardlink source to destination, copying when linking is not possible"""
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ArtifactStore:
+    """Files keyed by the sha256 of their content, each unique content stored once
+
+    Subject directories hold hardlinks to the objects, so identical scale
+    images, recommendation tables and missing data figures take one inode
+    however many subjects use them. Objects are read-only, files linked from
+    the store must be removed rather than overwritten.
+    """
+
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        # (path, mtime_ns, size) -> object path of files already stored by this process
+        self._files = {}
+
+    def object_path(self, digest, suffix=''):
+        return os.path.join(self.root, digest[:2], digest + suffix)
+
+    def put_bytes(self, data, suffix=''):
+        """Store data unless an object with the same content exists and return the object path"""
+        path = self.object_path(hashlib.sha256(data).hexdigest(), suffix)
+        if os.path.exists(path):
+            # A reused object counts as new for gc(since) until it is linked
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+        return path
+
+    def put_file(self, source):
+        """Store a file's content, hashing each unchanged file only once per process"""
+        stat = os.stat(source)
+        key = (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+        if key not in self._files or not os.path.exists(self._files[key]):
+            with open(source, 'rb') as f:
+                self._files[key] = self.put_bytes(f.read(), os.path.splitext(source)[1])
+        else:
+            os.utime(self._files[key])
+        return self._files[key]
+
+    def link(self, object_path, destination):
+        link_file(object_path, destination)
+        return destination
+
+    def gc(self, since=None):
+        """Remove objects no longer linked from anywhere (link count 1)
+
+        Objects stored or reused at or after the time.time() value since are
+        kept, another run may be about to link them. Other runs sharing the
+        store should still be finished or not started: an object reused
+        before since and not linked yet is removed.
+
+        Returns:
+            Number of removed objects and their total size in bytes
+        """
+        removed, size = 0, 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                if stat.st_nlink == 1 and not name.endswith('.tmp') \
+                        and (since is None or stat.st_mtime < since):
+                    os.remove(path)
+                    removed += 1
+                    size += stat.st_size
+        self._files.clear()
+        return removed, size
+
+
+_store = None
+
+def get_store():
+    """Return the artifact store shared within this process"""
+    global _store
+    if _store is None:
+        _store = ArtifactStore()
+    return _store
@@ -0,0 +1,105 @@
+import struct
+import zlib
+import numpy as np
+
+# Rows per independently compressed band
+BAND_ROWS = 64
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG row filters used: the first row of a band only refers to itself, the others to the row above
+FILTER_SUB = 1
+FILTER_UP = 2
+
+
+def adler32_combine(adler1, adler2, length2):
+    """Adler-32 of two byte strings joined, from the checksum of each and the length of the second"""
+    base = 65521
+    remainder = length2 % base
+    low1 = adler1 & 0xffff
+    sum1 = (low1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (remainder * low1 + (adler1 >> 16) + (adler2 >> 16) + base - remainder) % base
+    return (sum2 << 16) | sum1
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def filter_rows(rows):
+    """PNG scanlines of an (n, width, 4) RGBA band, filter byte first"""
+    n, width = rows.shape[:2]
+    lines = np.empty((n, 1 + width * 4), dtype=np.uint8)
+    lines[0, 0] = FILTER_SUB
+    lines[1:, 0] = FILTER_UP
+    first = rows[0].reshape(-1)
+    lines[0, 1:5] = first[:4]
+    lines[0, 5:] = first[4:] - first[:-4]
+    lines[1:, 1:] = (rows[1:] - rows[:-1]).reshape(n - 1, -1)
+    return lines
+
+
+def unfilter_rows(lines, width):
+    """Inverse of filter_rows"""
+    data = lines[:, 1:].reshape(len(lines), width, 4)
+    rows = np.cumsum(data, axis=0, dtype=np.uint8)
+    rows += np.cumsum(data[0], axis=0, dtype=np.uint8) - data[0]
+    return rows
+
+
+class BandedPNG:
+    """PNG encoder of RGBA images that differ from a fixed background in a few rows
+
+    Rows are filtered and deflated in bands of band_rows, each band compressed
+    on its own (a full flush resets the compressor), so the compressed bands of
+    the background are reused and only bands with changed rows are compressed
+    again. Deflate streams ending in a full flush can simply be concatenated.
+    """
+
+    def __init__(self, background, dpi=None, level=6, band_rows=BAND_ROWS):
+        self.height, self.width = background.shape[:2]
+        self.dpi = dpi
+        self.level = level
+        self.band_rows = band_rows
+        self.bands = [self._compress(background[start:start + band_rows])
+                      for start in range(0, self.height, band_rows)]
+
+    def _compress(self, rows):
+        lines = filter_rows(rows).tobytes()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        data = compressor.compress(lines) + compressor.flush(zlib.Z_FULL_FLUSH)
+        return data, zlib.adler32(lines), len(lines)
+
+    def band_of(self, row):
+        return row // self.band_rows
+
+    def background_rows(self, band):
+        """Background pixels of a band"""
+        data = self.bands[band][0]
+        # A band alone is not a complete stream, so a decompressor object is needed
+        lines = np.frombuffer(zlib.decompressobj(-15).decompress(data), dtype=np.uint8)
+        return unfilter_rows(lines.reshape(-1, 1 + self.width * 4), self.width)
+
+    def encode(self, image, changed_bands):
+        """PNG bytes of image, which matches the background outside changed_bands"""
+        header = struct.pack('>IIBBBBB', self.width, self.height, 8, 6, 0, 0, 0)
+        parts = [PNG_SIGNATURE, _chunk(b'IHDR', header)]
+        if self.dpi:
+            pixels_per_meter = round(self.dpi / 0.0254)
+            parts.append(_chunk(b'pHYs', struct.pack('>IIB', pixels_per_meter, pixels_per_meter, 1)))
+
+        deflated = [b'\x78\x9c']
+        adler = 1
+        for band, compressed in enumerate(self.bands):
+            if band in changed_bands:
+                start = band * self.band_rows
+                compressed = self._compress(image[start:start + self.band_rows])
+            data, band_adler, length = compressed
+            deflated.append(data)
+            adler = adler32_combine(adler, band_adler, length)
+        # An empty final block closes the deflate stream
+        deflated.append(b'\x03\x00' + struct.pack('>I', adler))
+
+        parts.append(_chunk(b'IDAT', b''.join(deflated)))
+        parts.append(_chunk(b'IEND', b''))
+        return b''.join(parts)
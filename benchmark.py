@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Inputs copied next to the synthetic data, besides data/
+PIPELINE_FILES = ['assets', 'template.tex', 'factors.tex', 'factors_empty.tex', 'Arial.ttf']
+
+STAGES = ['preprocess', 'classify', 'reports']
+
+# Stand-in for lualatex: records first pages of batch documents and writes blank PDFs
+STUB_LUALATEX = r'''#!/usr/bin/env python3
+import re, sys
+from pypdf import PdfWriter
+
+args = sys.argv[1:]
+if args and args[0] == '--version':
+    print('lualatex stub')
+    sys.exit(0)
+if '-ini' in args:
+    jobname = next(arg for arg in args if arg.startswith('-jobname=')).split('=', 1)[1]
+    open(f'{jobname}.fmt', 'w').close()
+    sys.exit(0)
+
+tex = next(arg for arg in args if arg.endswith('.tex'))
+base = tex[:-len('.tex')]
+with open(tex, encoding='utf-8') as f:
+    subjects = re.findall(r'\\write\\subjectpages\{(\d+) ', f.read())
+
+pages_per_subject = 4
+if subjects:
+    with open(f'{base}.pages', 'w') as f:
+        for i, subject in enumerate(subjects):
+            f.write(f'{subject} {i * pages_per_subject + 1}\n')
+        f.write(f'end {len(subjects) * pages_per_subject}\n')
+
+writer = PdfWriter()
+for _ in range(pages_per_subject * max(len(subjects), 1)):
+    writer.add_blank_page(595, 842)
+writer.write(f'{base}.pdf')
+'''
+
+
+def run_stage(name, report_args):
+    """Run one pipeline stage in the current directory and return its measurements"""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    if name == 'preprocess':
+        import preprocess_eeg
+        preprocess_eeg.process_tables()
+    elif name == 'classify':
+        from modify_factor import CohortStats
+        from generate_texes import TASKS
+        CohortStats(TASKS)
+    elif name == 'reports':
+        import generate_texes
+        generate_texes.main(['--force', '--trace', 'trace.jsonl'] + report_args)
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.perf_counter() - wall_start,
+        'cpu': time.process_time() - cpu_start + usage.ru_utime + usage.ru_stime,
+        'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, usage.ru_maxrss) / 1024,
+    }
+
+
+def prepare_workdir(workdir, n_subjects, stub_tex, seed=0):
+    """Generate synthetic inputs and copy the templates and assets into workdir"""
+    from synthetic_cohort import generate_cohort
+
+    os.makedirs(workdir, exist_ok=True)
+    generate_cohort(workdir, n_subjects, seed)
+    for name in PIPELINE_FILES:
+        source = name if os.path.exists(name) else os.path.join(SOURCE_DIR, name)
+        if not os.path.exists(source):
+            continue
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(workdir, name), dirs_exist_ok=True)
+        else:
+            shutil.copy(source, workdir)
+
+    env = dict(os.environ, MPLBACKEND='Agg')
+    if stub_tex:
+        bin_dir = os.path.join(workdir, 'bin')
+        os.makedirs(bin_dir, exist_ok=True)
+        stub_path = os.path.join(bin_dir, 'lualatex')
+        with open(stub_path, 'w') as f:
+            f.write(STUB_LUALATEX)
+        os.chmod(stub_path, 0o755)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    return env
+
+
+def benchmark_size(workdir, n_subjects, args):
+    """Time every stage for one cohort size, each stage in a fresh process"""
+    env = prepare_workdir(workdir, n_subjects, args.stub_tex, args.seed)
+    n_reports = min(n_subjects, args.report_subjects)
+    report_args = ['--jobs', str(args.jobs), '--subjects'] + [f"7{sub:02d}" for sub in range(1, n_reports + 1)]
+    if args.batch_size:
+        report_args += ['--batch-size', str(args.batch_size)]
+
+    measurements = []
+    for name in args.stages:
+        command = [sys.executable, os.path.abspath(__file__), '--run-stage', name, '--']
+        if name == 'reports':
+            command += report_args
+        completed = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stdout[-2000:], completed.stderr[-2000:], sep='\n')
+            raise RuntimeError(f"stage {name} failed for {n_subjects} subjects")
+
+        measurement = json.loads(completed.stdout.strip().splitlines()[-1])
+        measurement.update(stage=name, cohort=n_subjects,
+                           subjects=n_reports if name == 'reports' else n_subjects)
+        measurement['throughput'] = measurement['subjects'] / measurement['wall']
+        measurements.append(measurement)
+    return measurements
+
+
+def print_report(measurements):
+    print(f"{'cohort':>8} {'stage':<12}{'subjects':>9}{'wall, s':>10}{'cpu, s':>10}"
+          f"{'subjects/s':>12}{'peak RSS, MB':>14}")
+    for m in measurements:
+        print(f"{m['cohort']:>8} {m['stage']:<12}{m['subjects']:>9}{m['wall']:>10.2f}{m['cpu']:>10.2f}"
+              f"{m['throughput']:>12.1f}{m['peak_rss_mb']:>14.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic cohorts of growing size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[30, 300, 3000],
+                        help="cohort sizes to benchmark (default: 30 300 3000)")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--report-subjects', type=int, default=20,
+                        help="number of subjects rendered in the reports stage (default: 20)")
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=0)
+    parser.add_argument('--stub-tex', action='store_true',
+                        help="replace lualatex with a stub writing blank PDFs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="keep generated cohorts here instead of a temporary directory")
+    parser.add_argument('--output', metavar='PATH', help="also write measurements as JSON lines")
+    args = parser.parse_args(argv)
+
+    root = args.workdir or tempfile.mkdtemp(prefix='ekf-benchmark-')
+    measurements = []
+    try:
+        for n_subjects in args.sizes:
+            print(f"Benchmarking {n_subjects} subjects")
+            measurements += benchmark_size(os.path.join(root, f"cohort_{n_subjects}"), n_subjects, args)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_report(measurements)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for measurement in measurements:
+                f.write(json.dumps(measurement) + '\n')
+    return measurements
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--run-stage':
+        # Child process of benchmark_size: arguments after -- go to generate_texes
+        sys.path.insert(0, SOURCE_DIR)
+        stage_result = run_stage(sys.argv[2], sys.argv[4:])
+        print(json.dumps(stage_result))
+    else:
+        main()
@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+
+MANIFEST_PATH = "subjects/manifest.json"
+
+
+def hash_values(*values):
+    """Return sha256 hex digest of JSON-serializable values"""
+    payload = json.dumps(values, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class BuildManifest:
+    """Input digest of every generated subject PDF
+
+    The manifest is saved after each recorded subject, so an interrupted run
+    resumes from the subjects that were not finished yet.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.subjects = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.subjects = json.load(f)['subjects']
+
+    def is_up_to_date(self, subject, digest):
+        entry = self.subjects.get(subject)
+        return entry is not None and entry['digest'] == digest and os.path.exists(entry['pdf'])
+
+    def record(self, subject, digest, pdf_path):
+        self.subjects[subject] = {'digest': digest, 'pdf': pdf_path}
+        self.save()
+
+    def forget(self, subject):
+        if self.subjects.pop(subject, None) is not None:
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'subjects': self.subjects}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,84 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+TEST_NAMES = ['CombFunction', 'MentalArithmetic', 'VisualSearch', 'WorkingMemory']
+
+
+@dataclass
+class Cohort:
+    """Input tables and output directories of one class"""
+    name: str
+    roster_path: str
+    norm_path: str
+    fatigue_path: str
+    # Test name -> raw test table, preprocessing writes <table>_modified.csv next to it
+    test_paths: Dict[str, str] = field(default_factory=dict)
+    # Prepended to the two-digit EEG `sub` number to get the subject code
+    subject_prefix: str = '7'
+    subjects_dir: str = "subjects"
+    pdfs_dir: str = "subjects_pdfs"
+
+    def modified_path(self, test_name):
+        return self.test_paths[test_name].replace('.csv', '_modified.csv')
+
+    def modified_paths(self):
+        return {test_name: self.modified_path(test_name) for test_name in self.test_paths}
+
+    @classmethod
+    def for_class(cls, grade, data_dir='data', name=None, **kwargs):
+        """Cohort with the file naming of the class 7 data: norm_var_7class.csv, CombFunction7.csv, ..."""
+        return cls(
+            name=name or str(grade),
+            roster_path=os.path.join(data_dir, f"список_{grade}класс.xlsx"),
+            norm_path=os.path.join(data_dir, f"norm_var_{grade}class.csv"),
+            fatigue_path=os.path.join(data_dir, f"Class{grade}Fatigue.csv"),
+            test_paths={test_name: os.path.join(data_dir, f"{test_name}{grade}.csv") for test_name in TEST_NAMES},
+            subject_prefix=str(grade),
+            **kwargs,
+        )
+
+
+DEFAULT_COHORT = Cohort.for_class(7)
+
+
+def load_cohorts(path) -> List[Cohort]:
+    """Read cohorts from a JSON config
+
+    Example:
+        {"cohorts": [
+            {"name": "school12-7", "grade": 7, "data_dir": "data/school12"},
+            {"name": "school12-8", "grade": 8, "data_dir": "data/school12", "roster_path": "data/school12/8.xlsx"}
+        ]}
+
+    Entries with "grade" follow the class file naming, any other key overrides
+    the corresponding Cohort field. Outputs go to subjects/<name> and
+    subjects_pdfs/<name> unless set explicitly.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    cohorts = []
+    for entry in config['cohorts']:
+        entry = dict(entry)
+        name = entry.pop('name')
+        entry.setdefault('subjects_dir', os.path.join("subjects", name))
+        entry.setdefault('pdfs_dir', os.path.join("subjects_pdfs", name))
+
+        if 'grade' in entry:
+            grade = entry.pop('grade')
+            data_dir = entry.pop('data_dir', 'data')
+            overrides = {key: entry.pop(key) for key in list(entry) if key not in ('subjects_dir', 'pdfs_dir')}
+            cohort = Cohort.for_class(grade, data_dir, name, subjects_dir=entry['subjects_dir'],
+                                      pdfs_dir=entry['pdfs_dir'])
+            for key, value in overrides.items():
+                setattr(cohort, key, value)
+        else:
+            cohort = Cohort(name=name, **entry)
+        cohorts.append(cohort)
+
+    names = [cohort.name for cohort in cohorts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate cohort names in {path}")
+    return cohorts
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+CACHE_DIR = '.cache/tables'
+
+
+def file_hash(path):
+    """Return sha256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_paths(path, options):
+    key_source = json.dumps([os.path.abspath(path), options], sort_keys=True)
+    key = hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+    base = os.path.join(CACHE_DIR, key)
+    return base + '.parquet', base + '.json'
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _is_fresh(path, meta_path, stat):
+    """Check cache metadata against the source, by mtime first and hash second"""
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+
+    if meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+        return True
+
+    # Source was touched, it is still fresh if the content did not change
+    if meta['size'] == stat.st_size and meta['sha256'] == file_hash(path):
+        meta['mtime_ns'] = stat.st_mtime_ns
+        _write_json(meta_path, meta)
+        return True
+    return False
+
+
+def _cached(path, options, loader, columns=None):
+    """Load a table through the Parquet cache, rebuilding it when the source changes"""
+    parquet_path, meta_path = _cache_paths(path, options)
+    stat = os.stat(path)
+
+    if os.path.exists(parquet_path) and _is_fresh(path, meta_path, stat):
+        return pd.read_parquet(parquet_path, columns=columns, memory_map=True)
+
+    df = loader()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, index=False)
+    except (TypeError, ValueError) as e:
+        # Mixed-type columns can't be stored in Parquet, serve the table uncached
+        print(f"Not caching {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, parquet_path)
+        _write_json(meta_path, {
+            'source': path,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': file_hash(path),
+        })
+
+    return df[columns] if columns is not None else df
+
+
+def read_csv(path, columns=None, categories=(), float32=()):
+    """Read a CSV file through the Parquet cache
+
+    Args:
+        path: Source CSV path
+        columns: Columns to load, all columns when None
+        categories: Columns stored with categorical dtype
+        float32: Columns stored as float32
+
+    Returns:
+        DataFrame with the requested columns
+    """
+    categories = list(categories)
+    float32 = list(float32)
+
+    def loader():
+        dtype = {column: 'category' for column in categories}
+        dtype.update({column: 'float32' for column in float32})
+        return pd.read_csv(path, dtype=dtype)
+
+    options = {'kind': 'csv', 'categories': categories, 'float32': float32}
+    return _cached(path, options, loader, columns)
+
+
+def read_excel(path, header=0):
+    """Read an Excel sheet through the Parquet cache
+
+    Multi-level headers are stored as JSON-encoded column names and
+    restored to a MultiIndex on load.
+    """
+    multi_header = isinstance(header, (list, tuple))
+
+    def loader():
+        df = pd.read_excel(path, header=header)
+        if multi_header:
+            df.columns = [json.dumps(list(column), ensure_ascii=False) for column in df.columns]
+        return df
+
+    options = {'kind': 'excel', 'header': header}
+    df = _cached(path, options, loader)
+    if multi_header:
+        df.columns = pd.MultiIndex.from_tuples([tuple(json.loads(column)) for column in df.columns])
+    return df
@@ -1,5 +1,7 @@
 import pandas as pd
-from typing import List
+from functools import lru_cache
+from typing import Dict, List, Tuple
+from artifact_store import get_store
 
 TASKS = {
     'CombFunction': 'Комбинация функций',
@@ -8,6 +10,21 @@ TASKS = {
     'WorkingMemory': 'Рабочая память'
 }
 
+RECOMMENDATIONS_PATH = 'data/recommendations.parquet'
+
+@lru_cache(maxsize=None)
+def load_recommendations(path: str = RECOMMENDATIONS_PATH) -> Tuple[pd.DataFrame, Dict[str, List[int]]]:
+    """
+    Loads the recommendations store once and indexes it by task.
+    
+    Returns:
+        DataFrame with all recommendations and a mapping from the `ЭКФ*` task
+        name to the positions of its rows
+    """
+    df = pd.read_parquet(path)
+    index = {task: list(positions) for task, positions in df.groupby('ЭКФ*', sort=False).indices.items()}
+    return df, index
+
 def merge_recommendations(tasks: List[str]) -> pd.DataFrame:
     """
     Preprocesses the recommendations data for given tasks.
@@ -18,14 +35,13 @@ def merge_recommendations(tasks: List[str]) -> pd.DataFrame:
     Returns:
         DataFrame with merged recommendations for the specified tasks
     """
-    df = pd.read_parquet('data/recommendations.parquet')
+    df, index = load_recommendations()
     
-    # Create query string for multiple tasks
-    query_parts = [f"`ЭКФ*` == '{TASKS[task]}'" for task in tasks]
-    query = ' | '.join(query_parts)
+    # Collect rows of all tasks, keeping the order of the store
+    positions = sorted(set().union(*(index.get(TASKS[task], []) for task in tasks)))
     
     # Filter dataframe and drop duplicates
-    filtered_df = df.query(query)[df.columns[1:]]
+    filtered_df = df.iloc[positions][df.columns[1:]]
     return filtered_df.drop_duplicates()
 
 def get_recommendation_table(df: pd.DataFrame, title: str) -> str:
@@ -42,7 +58,7 @@ def get_recommendation_table(df: pd.DataFrame, title: str) -> str:
 
     # Add each data row
     for _, row in df.iterrows():
-        rows.append(f"    {row[0]} & {row[1]} & {row[2]} \\\\ \\hline")
+        rows.append(f"    {row.iloc[0]} & {row.iloc[1]} & {row.iloc[2]} \\\\ \\hline")
 
     # Add the closing tags
     rows.append('\\end{longtable}')
@@ -52,8 +68,10 @@ def get_recommendation_table(df: pd.DataFrame, title: str) -> str:
     latex_table = '\n'.join(rows)
     return latex_table
 
-def generate_recommendation_table(tasks: List[str]): 
-    merged_df = merge_recommendations(tasks)
+@lru_cache(maxsize=None)
+def render_recommendation_table(tasks: Tuple[str, ...]) -> str:
+    """Renders the LaTeX table for a task combination, once per combination"""
+    merged_df = merge_recommendations(list(tasks))
     
     # Generate title by mapping tasks to their Russian names and formatting
     task_names = [TASKS[task] for task in tasks]
@@ -61,6 +79,9 @@ def generate_recommendation_table(tasks: List[str]):
     task_names = [task_names[0]] + [name.lower() for name in task_names[1:]]
     title = ', '.join(task_names)
     
-    latex_table = get_recommendation_table(merged_df, title)
-    with open('recomendations/recomendation_table.tex', 'w') as f:
-        f.write(latex_table)
\ No newline at end of file
+    return get_recommendation_table(merged_df, title)
+
+def generate_recommendation_table(tasks: List[str], output_path: str):
+    """Link the table for the tasks to output_path, subjects with the same tasks share one stored file"""
+    latex_table = render_recommendation_table(tuple(tasks))
+    get_store().link(get_store().put_bytes(latex_table.encode('utf-8'), '.tex'), output_path)
\ No newline at end of file
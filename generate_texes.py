@@ -1,26 +1,28 @@
+import argparse
+import asyncio
+import glob
 import os
 import pandas as pd
 import shutil
 import subprocess
-from image_overlay import create_iq_image
-from modify_factor import create_histograms
-from generate_recommendation import generate_recommendation_table
-
-# Read the Excel file
-df = pd.read_excel("data/список_7класс.xlsx", header=[0,1])
-
-# Read the template
-with open("template.tex", "r", encoding="utf-8") as file:
-    template_content = file.read()
-
-with open("factors.tex", "r", encoding="utf-8") as file:
-    factors_template_content = file.read()
-
-# Ensure the subjects and subjects_pdfs directories exist
-if not os.path.exists("subjects"):
-    os.makedirs("subjects")
-if not os.path.exists("subjects_pdfs"):
-    os.makedirs("subjects_pdfs")
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+from modify_factor import METRICS, CohortStats, create_histograms
+from generate_recommendation import RECOMMENDATIONS_PATH, generate_recommendation_table, load_recommendations
+from build_manifest import BuildManifest, hash_values
+from latex_format import ensure_format, prepare_template, remove_intermediates, run_latex, run_latex_async
+from latex_batch import compile_batch
+from pipeline import print_pipeline_stats, run_pipeline
+from report_options import (DEFAULT_DPI, DEFAULT_FIGURE_FORMAT, DEFAULT_LATEX_JOBS, DEFAULT_QUEUE_SIZE,
+                            FIGURE_FORMATS, LATEX_TIMEOUT)
+from cohorts import DEFAULT_COHORT, load_cohorts
+from artifact_store import get_store
+from shards import parse_shard, shard_manifest_path, shard_of, write_shard_manifest
+import data_cache
+import instrumentation
+from instrumentation import stage
 
 RECOMENDATION_HEADER = r"""\begin{center}
     \textbf{\large Рекомендации}
@@ -39,41 +41,131 @@ factors_text = r"\input{factors.tex}"
 
 TASKS = ['CombFunction', 'MentalArithmetic', 'VisualSearch', 'WorkingMemory']
 
-# redo = [710, 711, 714, 722, 702, 747, 751]
-redo = [701]
-with_recomendations = 0
-# Process each row in the dataframe
-for _, row in df.iterrows():
-    subject_code = str(row[('код', 'Unnamed: 0_level_1')])
-    # if int(subject_code) not in redo:
-    #     print(f"Skipping {subject_code}")
-    #     continue
+KETTEL_FACTORS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'O', 'Q2', 'Q3', 'Q4']
+
+# Files that affect every report, besides the assets directory
+SHARED_INPUTS = ["template.tex", "factors.tex", RECOMMENDATIONS_PATH]
+
+# Pipeline modules, a change in the code invalidates all reports
+PIPELINE_SOURCES = ['generate_texes.py', 'modify_factor.py', 'image_overlay.py',
+                    'generate_recommendation.py', 'latex_format.py', 'latex_batch.py', 'cohorts.py', 'pipeline.py',
+                    'banded_png.py']
+
+
+def get_subject_code(row):
+    return str(row[('код', 'Unnamed: 0_level_1')])
+
+
+def needs_recommendation(groups, is_existing_data):
+    """A test gets recommendations when the subject is in group C by any metric"""
+    return is_existing_data and any(group == 'C' for group in groups.values())
+
+
+def read_text(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+
+def load_cohort_stats(cohort, stats_dir=None):
+    """Classify a cohort, or load its statistics saved to stats_dir by --save-cohort-stats"""
+    if stats_dir is not None:
+        return CohortStats.load(os.path.join(stats_dir, f"{cohort.name}.pickle"))
+    return CohortStats(TASKS, paths=cohort.modified_paths())
+
+
+def build_latex_format():
+    """Build the LaTeX format of template.tex, before starting workers that only look it up"""
+    return ensure_format(prepare_template(read_text("template.tex")))
 
+
+def load_context(use_format=True, cohorts=(DEFAULT_COHORT,), stats_dir=None, figure_format=DEFAULT_FIGURE_FORMAT, dpi=DEFAULT_DPI,
+                 build_format=True):
+    """Load everything shared between subjects: templates, recommendations and cohort statistics
+
+    With use_format the shared preamble is precompiled into a LaTeX format
+    (built once and reused until the preamble changes). Pool workers load
+    with build_format=False and only use the format built by their parent,
+    so they don't all build it at once. Statistics of every cohort are kept
+    apart, keyed by cohort name. Histograms are saved in figure_format, PNGs
+    at dpi.
+    """
+    load_recommendations()
+    template = prepare_template(read_text("template.tex"))
+    return {
+        'template': template,
+        'factors_template': read_text("factors.tex"),
+        'latex_format': ensure_format(template, build=build_format) if use_format else None,
+        # Load test tables and classify each cohort once
+        'cohorts': {cohort.name: load_cohort_stats(cohort, stats_dir) for cohort in cohorts},
+        'figure_format': figure_format,
+        'dpi': dpi,
+    }
+
+
+def shared_inputs_digest(*options):
+    """Digest of the inputs shared by all subjects of all cohorts: templates, assets, code and output options"""
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = SHARED_INPUTS + sorted(glob.glob("assets/*"))
+    paths += [os.path.join(source_dir, source) for source in PIPELINE_SOURCES]
+    files = [(os.path.basename(path), data_cache.file_hash(path)) for path in paths if os.path.exists(path)]
+    return hash_values(files, options)
+
+
+def subject_digests(rows, cohort, shared_digest):
+    """Digest of every input of each subject's PDF, keyed by subject code
+
+    Besides the shared inputs and the subject's own rows, the digest covers
+    the cohort's metric columns behind every histogram: another subject's
+    value changes the bars, bins and layout of all figures.
+    """
+    columns = [(test, metric, cohort.tables[test][METRICS[metric]].tolist()) for test, metric in cohort.histograms]
+    cohort_digest = hash_values(shared_digest, columns)
+    records = {
+        test: {subject: group.to_dict('records') for subject, group in df.groupby('subject')}
+        for test, df in cohort.tables.items()
+    }
+
+    digests = {}
+    for row in rows:
+        subject_code = get_subject_code(row)
+        roster_values = [(list(key), value) for key, value in row.items()]
+        test_values = [records[test].get(int(subject_code), []) for test in cohort.tests]
+        digests[subject_code] = hash_values(cohort_digest, roster_values, test_values)
+    return digests
+
+
+def prepare_subject(row, context, cohort=DEFAULT_COHORT):
+    """Generate assets and tex files for a single roster row of a cohort"""
+    subject_code = get_subject_code(row)
     iq = row[('IQ', 'Unnamed: 5_level_1')]
     subject_name = row[('ФИО', 'Unnamed: 2_level_1')]
+    # Create subject directory
+    subject_dir = os.path.join(cohort.subjects_dir, subject_code)
+    result = {'subject': subject_code, 'cohort': cohort.name, 'name': subject_name, 'recomendations': [],
+              'ok': False, 'error': None, 'pdf': None, 'dir': subject_dir, 'tex': f"{subject_code}.tex",
+              'destination': os.path.join(cohort.pdfs_dir, f"{subject_name}.pdf")}
     subst_dict = {}
     factors_subst_dict = {}
 
-    # Create subject directory
-    subject_dir = f"subjects/{subject_code}"
     if not os.path.exists(subject_dir):
         os.makedirs(subject_dir)
-    
+
     # Skip subjects without IQ value
     if pd.isna(iq):
         print(f"Skipping subject {subject_code} due to missing IQ value")
         subst_dict['<iq_image>'] = iq_image_empty_text
     else:
-        create_iq_image(subject_code, iq)
+        from image_overlay import create_iq_image
+        with stage('iq_image', subject_code):
+            create_iq_image(subject_code, iq, subject_dir)
         subst_dict['<iq_image>'] = iq_image_text
-        
+
     # Check if all Kettel factors are missing
-    kettel_factors = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'O', 'Q2', 'Q3', 'Q4']
-    if all(pd.isna(row[('Кеттел', factor)]) for factor in kettel_factors):
+    if all(pd.isna(row[('Кеттел', factor)]) for factor in KETTEL_FACTORS):
         print(f"Skipping subject {subject_code} due to missing all Kettel factor values")
         subst_dict['<factors>'] = factors_empty_text
     else:
-        for factor in kettel_factors:
+        for factor in KETTEL_FACTORS:
             factor_value = row[('Кеттел', factor)]
             if pd.isna(factor_value):
                 continue
@@ -81,76 +173,503 @@ for _, row in df.iterrows():
             scale_image = f"scale_{int(factor_value)}.png"
             scale_image_fullpath = f"assets/{scale_image}"
             factors_subst_dict[f'<factor_{factor.lower()}>'] = scale_image
-            
-            # Copy scale image to subject directory
-            shutil.copy(scale_image_fullpath, os.path.join(subject_dir, scale_image))
+
+            # Link the stored scale image into the subject directory
+            store = get_store()
+            store.link(store.put_file(scale_image_fullpath), os.path.join(subject_dir, scale_image))
         subst_dict['<factors>'] = factors_text
-    
-    
-    recomendations = [] 
+
+
+    recomendations = result['recomendations']
     # Generate histograms
     for test in TASKS:
-        groups, is_existing_data = create_histograms(test, subject_code)
-        score = [int(v in ['C']) for v in groups.values()]
-        sum_score = sum(score)
-        if sum_score >= 1 and is_existing_data:
+        with stage(f'histograms:{test}', subject_code):
+            groups, is_existing_data = create_histograms(test, subject_code, cohort=context['cohorts'][cohort.name],
+                                                         subject_dir=subject_dir,
+                                                         figure_format=context['figure_format'], dpi=context['dpi'])
+        if needs_recommendation(groups, is_existing_data):
             recomendations.append(test)
     print(recomendations)
-    with_recomendations += 1 if recomendations else 0
-    
+
     # Prepare substitution dictionary
-    
+
     if recomendations:
         subst_dict['<RecomendationHeader>'] = RECOMENDATION_HEADER
-        generate_recommendation_table(recomendations)
         recomendations_tex_path = os.path.join(subject_dir, RECOMENDATION_TEX_FNAME)
+        with stage('recommendation_table', subject_code):
+            generate_recommendation_table(recomendations, recomendations_tex_path)
         subst_dict['<Recomendation>'] = r"\input{" + RECOMENDATION_TEX_FNAME + "}"
-        shutil.copy(os.path.join("recomendations", RECOMENDATION_TEX_FNAME), recomendations_tex_path)
     else:
         subst_dict['<RecomendationHeader>'] = ""
         subst_dict['<Recomendation>'] = ""
 
-    # Generate customized tex file
-    customized_content = template_content
-    for key, value in subst_dict.items():
-        customized_content = customized_content.replace(key, value)
-    
-    customized_factors_content = factors_template_content
-    for key, value in factors_subst_dict.items():
-        customized_factors_content = customized_factors_content.replace(key, value)
-    
-    # Write customized tex file
-    tex_file_path = os.path.join(subject_dir, f"{subject_code}.tex")
-    with open(tex_file_path, "w", encoding="utf-8") as file:
-        file.write(customized_content)
-    
-    factors_tex_file_path = os.path.join(subject_dir, 'factors.tex')
-    with open(factors_tex_file_path, 'w', encoding='utf-8') as file:
-        file.write(customized_factors_content)
-        
+    with stage('template', subject_code):
+        # Generate customized tex file
+        customized_content = context['template']
+        for key, value in subst_dict.items():
+            customized_content = customized_content.replace(key, value)
+
+        customized_factors_content = context['factors_template']
+        for key, value in factors_subst_dict.items():
+            customized_factors_content = customized_factors_content.replace(key, value)
+
+        # Write customized tex file
+        tex_file_path = os.path.join(subject_dir, result['tex'])
+        with open(tex_file_path, "w", encoding="utf-8") as file:
+            file.write(customized_content)
+
+        factors_tex_file_path = os.path.join(subject_dir, 'factors.tex')
+        with open(factors_tex_file_path, 'w', encoding='utf-8') as file:
+            file.write(customized_factors_content)
+
+    return result
+
+
+def compile_subject(result, context):
+    """Render a prepared subject's tex file to PDF and move it to the cohort's PDF directory"""
+    subject_name = result['name']
+    subject_dir = result['dir']
+
     # Render TEX file to PDF using LuaLaTeX
     print(f"Generating PDF for {subject_name}")
     try:
-        # Change to the subject directory before running LuaLaTeX
-        current_dir = os.getcwd()
-        os.chdir(subject_dir)
-        
-        subprocess.run(['lualatex', f"{subject_code}.tex"], 
-                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        # Change back to the original directory
-        os.chdir(current_dir)
-        
-        # Move and rename the PDF to subjects_pdfs directory
-        pdf_source = os.path.join(subject_dir, f"{subject_code}.pdf")
-        pdf_destination = os.path.join("subjects_pdfs", f"{subject_name}.pdf")
-        shutil.move(pdf_source, pdf_destination)
-        print(f"Generated PDF for {subject_name}")
-    except subprocess.CalledProcessError:
+        # Run LuaLaTeX inside the subject directory
+        with stage('lualatex', result['subject']):
+            run_latex(result['tex'], subject_dir, context['latex_format'])
+        move_pdf(result)
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to generate PDF for {subject_name}")
+        result['error'] = str(e)
+
+    return result
+
+
+async def compile_subject_async(result, context, timeout=LATEX_TIMEOUT):
+    """compile_subject with the engine as an asyncio subprocess, killed after timeout seconds
+
+    Unexpected errors turn into a failed result. Stage timings recorded
+    meanwhile are added to result['trace'].
+    """
+    subject_name = result['name']
+    print(f"Generating PDF for {subject_name}")
+    try:
+        # Engines exit while others run, their CPU time can't be told apart
+        with stage('lualatex', result['subject'], cpu=False):
+            await run_latex_async(result['tex'], result['dir'], context['latex_format'], timeout)
+        move_pdf(result)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         print(f"Failed to generate PDF for {subject_name}")
-        # Change back to the original directory in case of error
-        os.chdir(current_dir)
-    
-print(f'{with_recomendations=}')
+        result['error'] = str(e)
+    except Exception as e:
+        print(f"Error processing subject {result['subject']}: {e!r}")
+        result['error'] = repr(e)
+
+    result['trace'].extend(instrumentation.drain())
+    return result
+
+
+def move_pdf(result):
+    """Move a compiled subject's PDF to the PDF directory of its cohort and remove the engine intermediates"""
+    pdf_source = os.path.join(result['dir'], result['tex'].replace('.tex', '.pdf'))
+    with stage('pdf_move', result['subject']):
+        shutil.move(pdf_source, result['destination'])
+        remove_intermediates(result['tex'], result['dir'])
+    print(f"Generated PDF for {result['name']}")
+    result['ok'] = True
+    result['pdf'] = result['destination']
+
+
+def generate_subject(row, context, cohort=DEFAULT_COHORT):
+    """Generate assets, tex files and the PDF for a single roster row"""
+    return compile_subject(prepare_subject(row, context, cohort), context)
+
+
+def run_subject(row, context, compile=True, cohort=DEFAULT_COHORT):
+    """Generate a single subject, turning unexpected errors into a failed result
+
+    With compile=False only assets and tex files are generated. Stage timings
+    recorded meanwhile are returned in result['trace'].
+    """
+    try:
+        if not compile:
+            result = prepare_subject(row, context, cohort)
+        else:
+            result = generate_subject(row, context, cohort)
+    except Exception as e:
+        subject_code = get_subject_code(row)
+        print(f"Error processing subject {subject_code}: {e!r}")
+        result = {'subject': subject_code, 'cohort': cohort.name, 'name': row[('ФИО', 'Unnamed: 2_level_1')],
+                  'recomendations': [], 'ok': False, 'error': repr(e), 'pdf': None}
+    result['trace'] = instrumentation.drain()
+    return result
+
+
+def run_batch(name, results, context):
+    """Compile prepared subjects in one batch, falling back to one by one if the batch fails
+
+    Unexpected errors of a subject compiled alone turn into a failed result,
+    the other subjects are still compiled.
+    """
+    if not compile_batch(name, results, context):
+        for result in results:
+            try:
+                compile_subject(result, context)
+            except Exception as e:
+                print(f"Error processing subject {result['subject']}: {e!r}")
+                result['error'] = repr(e)
+
+    # Batch stage timings go with the first subject of the batch
+    results[0]['trace'].extend(instrumentation.drain())
+    return results
+
+
+# Per-process context of pool workers loaded by _init_worker, or of this process in serial runs
+_worker_context = None
+
+def _init_worker(cohorts, context_options):
+    global _worker_context
+    _worker_context = load_context(cohorts=cohorts, build_format=False, **context_options)
+
+def _run_subject_in_worker(subject, compile=True):
+    cohort, row = subject
+    return run_subject(row, _worker_context, compile, cohort)
+
+def _run_batch_in_worker(name, results):
+    return run_batch(name, results, _worker_context)
+
+
+def _iter_results(pool, function, *iterables):
+    """Yield results of function over the arguments as they complete, in the pool or in this process"""
+    if pool is None:
+        yield from map(function, *iterables)
+        return
+
+    futures = [pool.submit(function, *args) for args in zip(*iterables)]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def generate_reports(subjects, jobs=1, context=None, on_result=None, batch_size=0, compile=True, pipeline=False,
+                     latex_jobs=DEFAULT_LATEX_JOBS, queue_size=DEFAULT_QUEUE_SIZE, latex_timeout=LATEX_TIMEOUT,
+                     **context_options):
+    """Generate reports for (cohort, roster row) pairs, serially or across a process pool
+
+    context_options are passed to load_context in every worker (use_format,
+    stats_dir, figure_format, dpi).
+
+    Subjects of all cohorts share one pool. With batch_size all subjects are
+    prepared first and then typeset batch_size at a time, one engine run per
+    batch of a single cohort. With pipeline jobs worker processes prepare
+    assets while up to latex_jobs engine runs typeset the subjects prepared
+    before, with at most queue_size prepared subjects waiting. With
+    compile=False only assets and tex files are generated.
+    on_result is called in this process with every result as soon as it is ready.
+    """
+    global _worker_context
+    results = []
+    cohorts = list({cohort.name: cohort for cohort, _ in subjects}.values())
+
+    def collect(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    if pipeline and compile:
+        if context is None:
+            context = load_context(cohorts=cohorts, **context_options)
+        # Assets are prepared in worker processes even with one job, the engine runs from this process
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(cohorts, context_options)) as pool:
+            stats = asyncio.run(run_pipeline(subjects, partial(_run_subject_in_worker, compile=False),
+                                             partial(compile_subject_async, context=context, timeout=latex_timeout),
+                                             pool, jobs, latex_jobs, queue_size, collect))
+        print_pipeline_stats(stats)
+        return results
+
+    pool = None
+    if jobs > 1:
+        if context is None and context_options.get('use_format', True):
+            build_latex_format()
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                   initargs=(cohorts, context_options))
+    else:
+        _worker_context = context if context is not None else load_context(cohorts=cohorts, **context_options)
+
+    try:
+        if not batch_size or not compile:
+            for result in _iter_results(pool, _run_subject_in_worker, subjects, [compile] * len(subjects)):
+                collect(result)
+            return results
+
+        prepared = []
+        for result in _iter_results(pool, _run_subject_in_worker, subjects, [False] * len(subjects)):
+            if result['error'] is None:
+                prepared.append(result)
+            else:
+                collect(result)
+
+        batches = []
+        for cohort in cohorts:
+            cohort_prepared = [result for result in prepared if result['cohort'] == cohort.name]
+            batches += [cohort_prepared[i:i + batch_size] for i in range(0, len(cohort_prepared), batch_size)]
+        names = [f"batch_{i:03d}" for i in range(len(batches))]
+        for batch in _iter_results(pool, _run_batch_in_worker, names, batches):
+            for result in batch:
+                collect(result)
+        return results
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def print_summary(results, skipped=0):
+    with_recomendations = sum(1 for result in results if result['recomendations'])
+    print(f'{with_recomendations=}')
+
+    failed = [result for result in results if not result['ok']]
+    print(f"Generated {len(results) - len(failed)} of {len(results)} PDFs, {skipped} up to date")
+    for result in failed:
+        print(f"  failed {result['cohort']}/{result['subject']} ({result['name']}): {result['error']}")
+
+
+def print_size_report(results, path=None, max_size_mb=None, top=5):
+    """Print total, mean and largest sizes of generated PDFs, optionally writing all sizes as CSV to path"""
+    sizes = [(result, os.path.getsize(result['pdf'])) for result in results
+             if result['ok'] and os.path.exists(result['pdf'])]
+    if not sizes:
+        return
+
+    total = sum(size for _, size in sizes)
+    print(f"PDF sizes: {total / 2**20:.1f} MB in total, {total / len(sizes) / 2**10:.0f} KB on average")
+    largest = sorted(sizes, key=lambda item: -item[1])
+    for result, size in largest[:top]:
+        print(f"  {size / 2**10:>8.0f} KB  {result['pdf']}")
+    if max_size_mb is not None:
+        too_large = [result for result, size in largest if size > max_size_mb * 2**20]
+        if too_large:
+            print(f"{len(too_large)} PDFs are larger than {max_size_mb} MB")
+
+    if path is not None:
+        pd.DataFrame([{'cohort': result['cohort'], 'subject': result['subject'], 'name': result['name'],
+                       'pdf': result['pdf'], 'bytes': size} for result, size in sizes]).to_csv(path, index=False)
+        print(f"Size report written to {path}")
+
+
+def print_plan(planned):
+    for entry in planned:
+        print(f"{entry['status']:<12}{entry['cohort']}/{entry['subject']}  {entry['name']}")
+    pending = sum(1 for entry in planned if entry['status'] == 'pending')
+    print(f"{pending} of {len(planned)} subjects would be rebuilt")
+
+
+def select_rows(cohort, subjects=None, shard=None):
+    """Roster rows of a cohort, optionally only subjects with codes (CODE or COHORT/CODE) in subjects and of a (K, N) shard"""
+    # Read the Excel file
+    with stage('roster_load'):
+        df = data_cache.read_excel(cohort.roster_path, header=[0,1])
+
+    rows = [row for _, row in df.iterrows()]
+    if subjects:
+        rows = [row for row in rows if get_subject_code(row) in subjects
+                or f"{cohort.name}/{get_subject_code(row)}" in subjects]
+    if shard:
+        shard_index, shard_count = shard
+        rows = [row for row in rows if shard_of(cohort.name, get_subject_code(row), shard_count) == shard_index]
+    return rows
+
+
+def plan_reports(cohorts, cohort_stats, shared_digest, subjects=None, shard=None, force=False):
+    """Split the selected subjects into pending and up to date ones by the digests of their inputs
+
+    Returns:
+        Dict with pending and up_to_date lists of (cohort, row), and manifests and digests keyed by cohort name
+    """
+    plan = {'pending': [], 'up_to_date': [], 'manifests': {}, 'digests': {}}
+    for cohort in cohorts:
+        rows = select_rows(cohort, subjects, shard)
+
+        # Skip subjects whose inputs did not change since their PDF was built
+        manifest = plan['manifests'][cohort.name] = BuildManifest(os.path.join(cohort.subjects_dir, "manifest.json"))
+        digests = plan['digests'][cohort.name] = subject_digests(rows, cohort_stats[cohort.name], shared_digest)
+        for row in rows:
+            up_to_date = not force and manifest.is_up_to_date(get_subject_code(row), digests[get_subject_code(row)])
+            plan['up_to_date' if up_to_date else 'pending'].append((cohort, row))
+    return plan
+
+
+def build(cohorts=None, subjects=None, shard=None, force=False, compile=True, dry_run=False, jobs=1, batch_size=0,
+          use_format=True, figure_format=DEFAULT_FIGURE_FORMAT, dpi=DEFAULT_DPI, stats_dir=None, trace=None,
+          size_report=None, max_pdf_size=None, pipeline=False, latex_jobs=DEFAULT_LATEX_JOBS,
+          queue_size=DEFAULT_QUEUE_SIZE, latex_timeout=LATEX_TIMEOUT, gc_store=False):
+    """Generate the reports of the selected subjects whose inputs changed
+
+    With compile=False only assets and tex files are generated. With dry_run
+    nothing is generated and only pandas is loaded. With pipeline assets and
+    TeX runs overlap, see generate_reports. With gc_store stored artifacts no
+    subject links to any more are removed at the end, except those used
+    since the build started.
+
+    Returns:
+        Result dicts of the generated subjects, or with dry_run dicts with
+        cohort, subject, name and status (pending or up_to_date)
+    """
+    cohorts = cohorts or [DEFAULT_COHORT]
+    started = time.time()
+    shared_digest = shared_inputs_digest(figure_format, dpi if figure_format == 'png' else None)
+
+    if dry_run:
+        cohort_stats = {cohort.name: load_cohort_stats(cohort, stats_dir) for cohort in cohorts}
+        plan = plan_reports(cohorts, cohort_stats, shared_digest, subjects, shard, force)
+        return [{'cohort': cohort.name, 'subject': get_subject_code(row), 'name': row[('ФИО', 'Unnamed: 2_level_1')],
+                 'status': status}
+                for status in ('pending', 'up_to_date') for cohort, row in plan[status]]
+
+    with stage('context_load'):
+        context = load_context(use_format, cohorts, stats_dir, figure_format, dpi)
+    plan = plan_reports(cohorts, context['cohorts'], shared_digest, subjects, shard, force)
+    manifests, digests = plan['manifests'], plan['digests']
+    pending, skipped = plan['pending'], len(plan['up_to_date'])
+    if skipped:
+        print(f"Skipping {skipped} up to date subjects")
+
+    from image_overlay import get_renderer
+    for cohort in cohorts:
+        # Ensure the subjects and PDF directories of the cohort exist
+        os.makedirs(cohort.subjects_dir, exist_ok=True)
+        os.makedirs(cohort.pdfs_dir, exist_ok=True)
+
+        # Render the IQ badges of all pending subjects at once, each unique value once
+        iq_by_subject = {get_subject_code(row): row[('IQ', 'Unnamed: 5_level_1')] for row_cohort, row in pending
+                         if row_cohort is cohort and pd.notna(row[('IQ', 'Unnamed: 5_level_1')])}
+        if iq_by_subject:
+            with stage('iq_image_batch'):
+                get_renderer().render_batch(iq_by_subject, cohort.subjects_dir)
+
+    events = []
+    # The trace file is closed even when generation fails, with the stages recorded until then
+    with (open(trace, 'w', encoding='utf-8') if trace else nullcontext()) as trace_file:
+        def record_events(new_events):
+            events.extend(new_events)
+            if trace_file is not None:
+                instrumentation.write_events(trace_file, new_events)
+
+        record_events(instrumentation.drain())
+
+        def record_result(result):
+            record_events(result['trace'])
+            if not compile:
+                return
+
+            manifest = manifests[result['cohort']]
+            if result['ok']:
+                manifest.record(result['subject'], digests[result['cohort']][result['subject']], result['pdf'])
+            else:
+                manifest.forget(result['subject'])
+
+        results = generate_reports(pending, jobs, context, on_result=record_result, batch_size=batch_size,
+                                   compile=compile, pipeline=pipeline, latex_jobs=latex_jobs, queue_size=queue_size,
+                                   latex_timeout=latex_timeout, use_format=use_format, stats_dir=stats_dir,
+                                   figure_format=figure_format, dpi=dpi)
+        if compile:
+            print_summary(results, skipped)
+            print_size_report(results, size_report, max_pdf_size)
+        else:
+            prepared = sum(1 for result in results if result['error'] is None)
+            print(f"Prepared tex files of {prepared} of {len(results)} subjects, {skipped} up to date")
+
+        if shard and compile:
+            entries = [{'cohort': result['cohort'], 'subject': result['subject'], 'name': result['name'],
+                        'status': 'ok' if result['ok'] else 'failed', 'pdf': result['pdf'], 'error': result['error']}
+                       for result in results]
+            for cohort, row in plan['up_to_date']:
+                subject_code = get_subject_code(row)
+                entries.append({'cohort': cohort.name, 'subject': subject_code, 'name': row[('ФИО', 'Unnamed: 2_level_1')],
+                                'status': 'up_to_date', 'pdf': manifests[cohort.name].subjects[subject_code]['pdf'],
+                                'error': None})
+            manifest_path = shard_manifest_path(*shard)
+            write_shard_manifest(manifest_path, *shard, entries)
+            print(f"Shard manifest written to {manifest_path}")
+
+        if gc_store:
+            # Stored artifacts no subject directory links to any more
+            removed, size = get_store().gc(since=started)
+            print(f"Removed {removed} unused stored artifacts ({size / 2**10:.0f} KB)")
+
+        record_events(instrumentation.drain())
+
+    if trace:
+        print(f"Trace written to {trace}")
+        instrumentation.print_trace_summary(events)
+
+    if compile and all(result['ok'] for result in results):
+        print("Tex files and PDFs generated successfully.")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate per-subject PDF reports")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="number of subjects processed in parallel (default: 1)")
+    parser.add_argument('--cohorts', metavar='CONFIG',
+                        help="JSON file listing the cohorts to process (default: class 7 in data/)")
+    parser.add_argument('--subjects', nargs='+', metavar='CODE',
+                        help="only process subjects with these codes, COHORT/CODE selects one cohort's subject")
+    parser.add_argument('--force', action='store_true',
+                        help="rebuild subjects even if their inputs did not change")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only list the subjects that would be rebuilt")
+    parser.add_argument('--no-format-cache', dest='format_cache', action='store_false',
+                        help="compile the full preamble for every subject instead of a precompiled format")
+    parser.add_argument('--trace', metavar='PATH',
+                        help="write per-stage timings as JSON lines and print the slowest stages and subjects")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help="typeset this many subjects per engine run and split the PDF (default: off)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="prepare assets in --jobs processes while earlier subjects are typeset")
+    parser.add_argument('--latex-jobs', type=int, default=DEFAULT_LATEX_JOBS,
+                        help=f"engine runs at once with --pipeline (default: {DEFAULT_LATEX_JOBS})")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help=f"prepared subjects waiting for the engine with --pipeline (default: {DEFAULT_QUEUE_SIZE})")
+    parser.add_argument('--latex-timeout', type=float, default=LATEX_TIMEOUT, metavar='SECONDS',
+                        help=f"kill engine runs taking longer with --pipeline (default: {LATEX_TIMEOUT})")
+    parser.add_argument('--figure-format', choices=FIGURE_FORMATS, default=DEFAULT_FIGURE_FORMAT,
+                        help="histogram format: vector pdf or raster png (default: png)")
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI,
+                        help=f"resolution of png histograms (default: {DEFAULT_DPI})")
+    parser.add_argument('--size-report', metavar='PATH',
+                        help="write the size of every generated PDF as CSV")
+    parser.add_argument('--max-pdf-size', type=float, metavar='MB',
+                        help="count PDFs larger than this in the size report")
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help="only process the K-th of N deterministic parts of the subjects "
+                             "and write shards/shard-K-of-N.json for shards.py merge")
+    parser.add_argument('--gc-store', action='store_true',
+                        help="remove stored artifacts no subject links to any more, "
+                             "while no other run or report server uses the store")
+    parser.add_argument('--cohort-stats', metavar='DIR',
+                        help="load cohort statistics saved by --save-cohort-stats instead of classifying")
+    parser.add_argument('--save-cohort-stats', metavar='DIR',
+                        help="classify the cohorts, save their statistics to DIR and exit")
+    args = parser.parse_args(argv)
+
+    cohorts = load_cohorts(args.cohorts) if args.cohorts else [DEFAULT_COHORT]
+
+    if args.save_cohort_stats:
+        os.makedirs(args.save_cohort_stats, exist_ok=True)
+        for cohort in cohorts:
+            load_cohort_stats(cohort).save(os.path.join(args.save_cohort_stats, f"{cohort.name}.pickle"))
+        print(f"Cohort statistics saved to {args.save_cohort_stats}")
+        return []
+
+    results = build(cohorts, args.subjects, args.shard, args.force, dry_run=args.dry_run, jobs=args.jobs,
+                    batch_size=args.batch_size, use_format=args.format_cache, figure_format=args.figure_format,
+                    dpi=args.dpi, stats_dir=args.cohort_stats, trace=args.trace, size_report=args.size_report,
+                    max_pdf_size=args.max_pdf_size, pipeline=args.pipeline, latex_jobs=args.latex_jobs,
+                    queue_size=args.queue_size, latex_timeout=args.latex_timeout, gc_store=args.gc_store)
+    if args.dry_run:
+        print_plan(results)
+    return results
+
 
-print("Tex files and PDFs generated successfully.")
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,141 @@
 from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+import hashlib
 import io
+import os
+import data_cache
+from artifact_store import link_file
+
+BASE_IMAGE_PATH = "assets/brain.jpg"
+FONT_PATH = "Arial.ttf"
+BADGE_CACHE_DIR = ".cache/iq_badges"
+
+def load_font(img):
+    # Choose a font (you may need to specify a font file path)
+    width, height = img.size
+    font_size = int(min(width, height) / 7)  # Adjust size as needed
+    return ImageFont.truetype(FONT_PATH, font_size)
+
+def draw_number(img, font, number):
+    # Create a drawing object
+    draw = ImageDraw.Draw(img)
+
+    # Get image dimensions
+    width, height = img.size
+
+    # Convert number to string
+    number_str = str(number)
+
+    # Get size of the text
+    left, top, right, bottom = font.getbbox(number_str)
+    text_width = right - left
+    text_height = bottom - top
+
+    # Calculate circle size and position
+    circle_diameter = max(text_width, text_height) * 1.8  # Increased for larger circle
+    circle_radius = circle_diameter / 2
+    circle_x = width / 2
+    circle_y = height / 3
+
+    # Increase border width
+    border_width = 5  # Adjust this value to increase or decrease border width
+
+    # Draw the white circle with thicker black border
+    draw.ellipse([circle_x - circle_radius, circle_y - circle_radius,
+                  circle_x + circle_radius, circle_y + circle_radius],
+                 fill='white', outline='black', width=border_width)
+
+    # Calculate position to center the text within the circle
+    text_x = circle_x - text_width / 2
+    text_y = circle_y - text_height / 1.3
+
+    # Draw the number
+    draw.text((text_x, text_y), number_str, fill='black', font=font)
 
 def overlay_number(image_path, number):
     # Open the image
     with Image.open(image_path) as img:
-        # Create a drawing object
-        draw = ImageDraw.Draw(img)
-        
-        # Get image dimensions
-        width, height = img.size
-        
-        # Choose a font (you may need to specify a font file path)
-        font_size = int(min(width, height) / 7)  # Adjust size as needed
-        font = ImageFont.truetype("Arial.ttf", font_size)
-        
-        # Convert number to string
-        number_str = str(number)
-        
-        # Get size of the text
-        left, top, right, bottom = font.getbbox(number_str)
-        text_width = right - left
-        text_height = bottom - top
-        
-        # Calculate circle size and position
-        circle_diameter = max(text_width, text_height) * 1.8  # Increased for larger circle
-        circle_radius = circle_diameter / 2
-        circle_x = width / 2
-        circle_y = height / 3
-        
-        # Increase border width
-        border_width = 5  # Adjust this value to increase or decrease border width
-        
-        # Draw the white circle with thicker black border
-        draw.ellipse([circle_x - circle_radius, circle_y - circle_radius,
-                      circle_x + circle_radius, circle_y + circle_radius],
-                     fill='white', outline='black', width=border_width)
-        
-        # Calculate position to center the text within the circle
-        text_x = circle_x - text_width / 2
-        text_y = circle_y - text_height / 1.3
-        
-        # Draw the number
-        draw.text((text_x, text_y), number_str, fill='black', font=font)
-        
+        draw_number(img, load_font(img), number)
+
         # Save to a bytes buffer
         buffer = io.BytesIO()
         img.save(buffer, format="PNG")
         buffer.seek(0)
-        
+
         return buffer
 
+class IQBadgeRenderer:
+    """Renders IQ badges from a decoded base image and a loaded font
+
+    Encoded badges are kept in memory for the most recent IQ values and
+    written once per value to BADGE_CACHE_DIR, from where they are linked
+    into subject directories.
+    """
+
+    def __init__(self, image_path=BASE_IMAGE_PATH, max_cached=64, cache_dir=BADGE_CACHE_DIR):
+        with Image.open(image_path) as img:
+            img.load()
+            self.base_image = img.copy()
+        self.font = load_font(self.base_image)
+        self.max_cached = max_cached
+        self.cache_dir = cache_dir
+        self._badges = OrderedDict()
+
+        # Badge files are tied to the base image and font they were drawn with
+        source = f"{data_cache.file_hash(image_path)}:{getattr(self.font, 'path', FONT_PATH)}"
+        self.digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+
+    def render(self, number):
+        """Return PNG bytes of the badge for a number"""
+        number = int(number)
+        if number in self._badges:
+            self._badges.move_to_end(number)
+            return self._badges[number]
+
+        img = self.base_image.copy()
+        draw_number(img, self.font, number)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+
+        self._badges[number] = buffer.getvalue()
+        if len(self._badges) > self.max_cached:
+            self._badges.popitem(last=False)
+        return self._badges[number]
+
+    def badge_path(self, number):
+        """Return path of the badge file for a number, rendering it if needed"""
+        path = os.path.join(self.cache_dir, f"iq_{int(number)}_{self.digest}.png")
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(self.render(number))
+            os.replace(tmp_path, path)
+        return path
+
+    def link_badge(self, number, destination):
+        link_file(self.badge_path(number), destination)
+
+    def render_batch(self, iq_by_subject, subjects_dir="subjects"):
+        """Render badges for {subject: iq} at once, one file per unique IQ value"""
+        paths = {int(iq): self.badge_path(iq) for iq in set(iq_by_subject.values())}
+        for subject_number, iq in iq_by_subject.items():
+            subject_dir = os.path.join(subjects_dir, str(subject_number))
+            os.makedirs(subject_dir, exist_ok=True)
+            link_file(paths[int(iq)], os.path.join(subject_dir, "output_image.png"))
+        return paths
+
+_renderer = None
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = IQBadgeRenderer()
+    return _renderer
+
 # Usage example:
 
-def create_iq_image(subject_number, iq_value):
-    result = overlay_number("assets/brain.jpg", int(iq_value))
-    with open(f"subjects/{subject_number}/output_image.png", "wb") as f:
-        f.write(result.getvalue())
+def create_iq_image(subject_number, iq_value, subject_dir=None):
+    if subject_dir is None:
+        subject_dir = f"subjects/{subject_number}"
+    get_renderer().link_badge(int(iq_value), f"{subject_dir}/output_image.png")
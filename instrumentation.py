@@ -0,0 +1,167 @@
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Stage events recorded in this process since the last drain()
+_events = []
+
+# Highest RSS seen so far by each open stage, keyed by a token of the stage
+_open_peaks = {}
+
+# Highest RSS of this process read before resetting the kernel's peak, which also resets ru_maxrss
+_reset_peak_mb = 0.0
+
+
+def _process_peak_rss_mb():
+    """Highest RSS of this process or of its largest waited-for child so far, in MB
+
+    It covers the whole process lifetime, so it only tells which stage
+    raised it.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(max(own, children) / 1024, _reset_peak_mb)
+
+
+def _rss_mb():
+    """Current RSS of this process in MB, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_mb():
+    """Highest RSS of this process since the last _reset_peak_rss() in MB, None where /proc is not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process to the current RSS, return False where Linux doesn't allow it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def stage(name, subject=None, cpu=True):
+    """Record wall time, CPU time (including child processes) and RSS of a stage
+
+    RSS is taken when the stage starts and ends. peak_rss_mb is the highest
+    RSS of the process while the stage ran: on Linux the kernel's peak is
+    reset when a stage starts (peaks of other open stages are kept), where
+    that is not possible the larger of the start and end RSS is used.
+    process_peak_rss_mb is the lifetime peak of the process so far. Stages
+    that overlap others in one process, like engine runs on an event loop,
+    can't tell whose children the CPU time belongs to and pass cpu=False to
+    record None.
+    """
+    token = object()
+    tracked = _track_peak(token)
+    rss_start = _rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time() + _children_cpu()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        rss_end = _rss_mb()
+        peak = _untrack_peak(token) if tracked else None
+        if peak is None and rss_start is not None and rss_end is not None:
+            peak = max(rss_start, rss_end)
+        _events.append({
+            'stage': name,
+            'subject': subject,
+            'wall': time.perf_counter() - wall_start,
+            'cpu': time.process_time() + _children_cpu() - cpu_start if cpu else None,
+            'rss_start_mb': rss_start,
+            'rss_end_mb': rss_end,
+            'peak_rss_mb': peak,
+            'process_peak_rss_mb': _process_peak_rss_mb(),
+            'pid': os.getpid(),
+            'ok': ok,
+        })
+
+
+def _track_peak(token):
+    """Start the peak RSS of a stage, return False if the kernel peak can't be reset"""
+    global _reset_peak_mb
+    current = _peak_rss_mb()
+    if current is None:
+        return False
+    _reset_peak_mb = max(_reset_peak_mb, current)
+    # Resetting would lose what the open stages have seen so far
+    for other, peak in _open_peaks.items():
+        _open_peaks[other] = max(peak, current)
+    if not _reset_peak_rss():
+        return False
+    _open_peaks[token] = 0.0
+    return True
+
+
+def _untrack_peak(token):
+    """Peak RSS of a stage since _track_peak(token)"""
+    peak = max(_open_peaks.pop(token), _peak_rss_mb() or 0.0)
+    for other, other_peak in _open_peaks.items():
+        _open_peaks[other] = max(other_peak, peak)
+    return peak
+
+
+def drain():
+    """Return and forget the events recorded so far"""
+    events = _events[:]
+    _events.clear()
+    return events
+
+
+def write_events(file, events):
+    for event in events:
+        file.write(json.dumps(event, ensure_ascii=False) + '\n')
+    file.flush()
+
+
+def print_trace_summary(events, top=10):
+    """Print total time, peak RSS and RSS growth per stage, and the slowest subjects"""
+    stages = defaultdict(lambda: [0, 0.0, None, 0.0, 0.0])
+    subjects = defaultdict(float)
+    for event in events:
+        totals = stages[event['stage']]
+        totals[0] += 1
+        totals[1] += event['wall']
+        if event['cpu'] is not None:
+            totals[2] = (totals[2] or 0.0) + event['cpu']
+        if event['peak_rss_mb'] is not None:
+            totals[3] = max(totals[3], event['peak_rss_mb'])
+        if event['rss_end_mb'] is not None:
+            totals[4] = max(totals[4], event['rss_end_mb'] - event['rss_start_mb'])
+        if event['subject'] is not None:
+            subjects[event['subject']] += event['wall']
+
+    print(f"{'stage':<28}{'count':>7}{'wall, s':>10}{'cpu, s':>10}{'peak RSS, MB':>15}{'growth, MB':>12}")
+    for name, (count, wall, cpu, rss, growth) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        cpu = f"{cpu:>10.2f}" if cpu is not None else f"{'-':>10}"
+        print(f"{name:<28}{count:>7}{wall:>10.2f}{cpu}{rss:>15.1f}{growth:>12.1f}")
+
+    print("\nSlowest subjects:")
+    for subject, wall in sorted(subjects.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {subject:<12}{wall:>10.2f} s")
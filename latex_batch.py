@@ -0,0 +1,117 @@
+import os
+from latex_format import remove_intermediates, run_latex
+from instrumentation import stage
+
+BATCH_DIR = "subjects"
+
+# Opens the file where the first page of every subject is recorded
+BATCH_SETUP = r"""\newwrite\subjectpages
+\immediate\openout\subjectpages=\jobname.pages
+"""
+
+# Starts a subject on a fresh page, with its own directory as input and graphics path
+SUBJECT_SETUP = r"""\clearpage
+\setcounter{page}{1}
+\setcounter{table}{0}
+\graphicspath{{<dir>/}}
+\makeatletter\def\input@path{{<dir>/}}\makeatother
+\immediate\write\subjectpages{<subject> \the\numexpr\value{abspage}+1\relax}
+"""
+
+BATCH_END = r"""\clearpage
+\immediate\write\subjectpages{end \the\value{abspage}}
+\immediate\closeout\subjectpages
+"""
+
+
+def build_batch_document(template, subjects):
+    """Assemble one document with the bodies of many subjects
+
+    Args:
+        template: Prepared report template
+        subjects: List of (subject code, subject directory relative to the batch, subject tex content)
+
+    Returns:
+        Content of the batch tex file
+    """
+    preamble, begin, _ = template.partition(r"\begin{document}")
+    parts = [preamble, begin, '\n', BATCH_SETUP]
+    for subject, subject_dir, content in subjects:
+        body = content.partition(r"\begin{document}")[2].rpartition(r"\end{document}")[0]
+        parts.append(SUBJECT_SETUP.replace('<dir>', subject_dir).replace('<subject>', subject))
+        parts.append(body)
+    parts.append(BATCH_END)
+    parts.append(r"\end{document}")
+    return ''.join(parts)
+
+
+def read_page_ranges(pages_path):
+    """Return {subject: (first page, last page)} with 0-based, inclusive page indices"""
+    with open(pages_path, 'r', encoding='utf-8') as f:
+        entries = [line.split() for line in f if line.strip()]
+
+    ranges = {}
+    for (subject, first), (next_subject, next_first) in zip(entries, entries[1:]):
+        # The end marker holds the total page count, other entries the next subject's first page
+        last = int(next_first) if next_subject == 'end' else int(next_first) - 1
+        ranges[subject] = (int(first) - 1, last - 1)
+    return ranges
+
+
+def split_pdf(pdf_path, page_ranges, destinations):
+    """Write each subject's page range of the batch PDF to its destination"""
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(pdf_path)
+    for subject, (first, last) in page_ranges.items():
+        writer = PdfWriter()
+        for page in reader.pages[first:last + 1]:
+            writer.add_page(page)
+        with open(destinations[subject], 'wb') as f:
+            writer.write(f)
+
+
+def compile_batch(name, results, context, batch_dir=BATCH_DIR):
+    """Typeset prepared subjects in one engine run and split the PDF per subject
+
+    Subject codes must be unique within a batch, so a batch holds subjects of
+    one cohort. Results are updated in place. If the batch can't be compiled
+    or split, the subjects are left uncompiled for the caller to compile one
+    by one.
+
+    Returns:
+        True if the batch PDF was split into subject PDFs
+    """
+    subjects = []
+    for result in results:
+        with open(os.path.join(result['dir'], result['tex']), 'r', encoding='utf-8') as f:
+            content = f.read()
+        subjects.append((result['subject'], os.path.relpath(result['dir'], batch_dir), content))
+
+    tex_path = os.path.join(batch_dir, f"{name}.tex")
+    with open(tex_path, 'w', encoding='utf-8') as f:
+        f.write(build_batch_document(context['template'], subjects))
+
+    print(f"Generating batch {name} with {len(results)} subjects")
+    try:
+        with stage('lualatex_batch'):
+            run_latex(f"{name}.tex", batch_dir, context['latex_format'])
+        page_ranges = read_page_ranges(os.path.join(batch_dir, f"{name}.pages"))
+        destinations = {result['subject']: result['destination'] for result in results}
+        if set(page_ranges) != set(destinations):
+            raise ValueError(f"page ranges recorded for {sorted(page_ranges)}")
+        with stage('pdf_split'):
+            split_pdf(os.path.join(batch_dir, f"{name}.pdf"), page_ranges, destinations)
+        os.remove(os.path.join(batch_dir, f"{name}.pdf"))
+        remove_intermediates(f"{name}.tex", batch_dir)
+        for suffix in ('.tex', '.pages'):
+            os.remove(os.path.join(batch_dir, name + suffix))
+    except Exception as e:
+        print(f"Failed to generate batch {name}: {e!r}")
+        return False
+
+    for result in results:
+        result['ok'] = True
+        result['pdf'] = destinations[result['subject']]
+    print(f"Generated batch {name}")
+    return True
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+LATEX_ENGINE = "lualatex"
+FORMAT_DIR = ".cache/latex_format"
+
+# Preamble lines that depend on Lua state, which LuaTeX can't dump into a format
+RUNTIME_PREAMBLE = ['{fontspec}', r'\setmainfont', r'\setsansfont', r'\setmonofont']
+
+# mylatexformat stops dumping here; defined as a no-op for runs without the format
+ENDOFDUMP = r"\providecommand{\endofdump}{}\endofdump"
+
+# Engine outputs not needed once the PDF is built
+INTERMEDIATE_SUFFIXES = ['.aux', '.log', '.out', '.toc', '.console.log']
+
+
+def prepare_template(template):
+    """Move the font setup to the end of the preamble, after the \\endofdump marker
+
+    Everything before the marker goes into the precompiled format, the font
+    setup is loaded by every document. The result compiles the same with and
+    without the format.
+    """
+    preamble, begin, body = template.partition(r"\begin{document}")
+    dumped, runtime = [], []
+    for line in preamble.splitlines():
+        if any(pattern in line for pattern in RUNTIME_PREAMBLE):
+            runtime.append(line)
+        else:
+            dumped.append(line)
+    return '\n'.join(dumped + [ENDOFDUMP] + runtime) + '\n' + begin + body
+
+
+def _engine_version(engine):
+    try:
+        completed = subprocess.run([engine, '--version'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.splitlines()[0] if completed.stdout else ''
+
+
+def ensure_format(template, engine=LATEX_ENGINE, format_dir=FORMAT_DIR, build=True):
+    """Build the format with the shared preamble of a prepared template
+
+    The format is named by a digest of the preamble and the engine version,
+    so it is rebuilt only when either changes. It is built in a directory of
+    its own and renamed into format_dir when complete, so another process
+    never finds a half-written format. With build=False an existing format
+    is only looked up: pool workers use the format their parent built.
+
+    Returns:
+        Absolute path of the format without extension, or None if it can't be built
+    """
+    version = _engine_version(engine)
+    if version is None:
+        return None
+
+    preamble = template.partition(ENDOFDUMP)[0]
+    digest = hashlib.sha256(f"{version}\n{preamble}".encode('utf-8')).hexdigest()
+    name = f"report-{digest[:12]}"
+    format_path = os.path.abspath(os.path.join(format_dir, name))
+    if os.path.exists(format_path + '.fmt'):
+        return format_path
+    if not build:
+        return None
+
+    os.makedirs(format_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=f"{name}-", dir=format_dir)
+    with open(os.path.join(build_dir, f"{name}.tex"), 'w', encoding='utf-8') as f:
+        f.write(template)
+
+    print(f"Building LaTeX format {name}")
+    try:
+        subprocess.run([engine, '-ini', f'-jobname={name}', '-interaction=nonstopmode',
+                        f'&{engine}', 'mylatexformat.ltx', f'{name}.tex'],
+                       cwd=build_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.replace(os.path.join(build_dir, f"{name}.fmt"), format_path + '.fmt')
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    finally:
+        if os.path.exists(os.path.join(build_dir, f"{name}.log")):
+            os.replace(os.path.join(build_dir, f"{name}.log"), format_path + '.log')
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    if not os.path.exists(format_path + '.fmt'):
+        print(f"Failed to build LaTeX format, see {os.path.join(format_dir, name)}.log")
+        return None
+    return format_path
+
+
+def run_latex(tex_fname, cwd, latex_format=None):
+    """Run LuaLaTeX on a file, with the precompiled preamble format when there is one
+
+    The console output is kept in <name>.console.log next to the tex file if
+    the run fails.
+    """
+    if latex_format is not None:
+        try:
+            _run_engine([LATEX_ENGINE, f"-fmt={latex_format}", tex_fname], tex_fname, cwd)
+            return
+        except subprocess.CalledProcessError:
+            print(f"Retrying {tex_fname} without the precompiled format")
+
+    _run_engine([LATEX_ENGINE, tex_fname], tex_fname, cwd)
+
+
+async def run_latex_async(tex_fname, cwd, latex_format=None, timeout=None):
+    """run_latex for an asyncio event loop, the engine is killed after timeout seconds
+
+    Raises:
+        subprocess.CalledProcessError if the engine fails, subprocess.TimeoutExpired if it is killed
+    """
+    if latex_format is not None:
+        try:
+            await _run_engine_async([LATEX_ENGINE, f"-fmt={latex_format}", tex_fname], tex_fname, cwd, timeout)
+            return
+        except subprocess.CalledProcessError:
+            print(f"Retrying {tex_fname} without the precompiled format")
+
+    await _run_engine_async([LATEX_ENGINE, tex_fname], tex_fname, cwd, timeout)
+
+
+def remove_intermediates(tex_fname, cwd):
+    """Remove aux, log and other engine outputs of a tex file once its PDF is built"""
+    base = os.path.join(cwd, tex_fname[:-len('.tex')])
+    for suffix in INTERMEDIATE_SUFFIXES:
+        if os.path.exists(base + suffix):
+            os.remove(base + suffix)
+
+
+def _run_engine(command, tex_fname, cwd):
+    try:
+        subprocess.run(command, cwd=cwd, check=True, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        _save_console_log(e.output, tex_fname, cwd)
+        raise
+
+
+async def _run_engine_async(command, tex_fname, cwd, timeout):
+    process = await asyncio.create_subprocess_exec(*command, cwd=cwd, stdin=subprocess.DEVNULL,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        print(f"Killed LaTeX on {tex_fname} after {timeout} s")
+        raise subprocess.TimeoutExpired(command, timeout)
+    if process.returncode != 0:
+        _save_console_log(output, tex_fname, cwd)
+        raise subprocess.CalledProcessError(process.returncode, command, output)
+
+
+def _save_console_log(output, tex_fname, cwd):
+    log_path = os.path.join(cwd, tex_fname.replace('.tex', '.console.log'))
+    with open(log_path, 'wb') as f:
+        f.write(output or b'')
+    print(f"LaTeX output saved to {log_path}")
@@ -1,6 +1,13 @@
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
+import io
+import os
+import pickle
+import data_cache
+from artifact_store import get_store
+from report_options import DEFAULT_DPI, DEFAULT_FIGURE_FORMAT, FIGURE_FORMATS
+
+# matplotlib is imported by the plotting code only, classification starts without it
 
 def determine_group(value, histogram_bins):
     """Determine group (A, B, or C) based on value and histogram boundaries"""
@@ -13,6 +20,50 @@ def determine_group(value, histogram_bins):
     else:
         return 'C'
 
+def draw_histogram_background(ax, data, histogram, xlabel):
+    """Draw the cohort histogram with group boundaries and A/B/C axis, return the twin axis"""
+    _, q1, left_bord, _, q2, _, right_bord, q3, _ = histogram[1]
+    
+    # Create histogram plot
+    ax.hist(data, 8, edgecolor='black', facecolor='lightgrey')
+    
+    # Set labels
+    ax.set_xlabel(xlabel, fontsize=26)
+    ax.set_ylabel('Число детей', fontsize=26)
+    
+    # Add vertical lines for group boundaries
+    ax.axvline(left_bord, color='red', linewidth=4)
+    ax.axvline(right_bord, color='red', linewidth=4)
+    
+    # Set up twin axis for group labels
+    ax2 = ax.twiny()
+    xmin, xmax = np.percentile(data, [0, 100])
+    ax.set_xlim([xmin, xmax])
+    ax2.set_xlim([xmin, xmax])
+    
+    # Add group labels
+    labels_position = [q1, q2, q3]
+    labels = ['A', 'B', 'C']
+    ax2.set_xticks(labels_position)
+    ax2.set_xticklabels(labels)
+    return ax2
+
+def subject_marker_height(histogram, subject_value):
+    """Height of the subject marker, a quarter of the bar the value falls into"""
+    bar_index = np.digitize(subject_value, histogram[1][:-1], right=True) - 1
+    return histogram[0][bar_index]/4
+
+def subject_title(title, subject_value, group):
+    return f"{title} {subject_value}\nРезультат - группа {group}"
+
+def draw_subject_marker(ax, histogram, subject_value, title):
+    """Draw the subject marker and title, return the group and the marker artists"""
+    markers = ax.plot(subject_value, subject_marker_height(histogram, subject_value), 'D', color='black', markersize=20)
+    
+    group = determine_group(subject_value, histogram[1])
+    ax.set_title(subject_title(title, f"{subject_value:.2f}", group), fontsize=30)
+    return group, markers
+
 def plot_single_histogram(ax, data, subject_value, title, xlabel, make_plots=True):
     """Plot a single histogram with group boundaries and subject marker"""
     data = data[pd.notna(data)]
@@ -20,40 +71,13 @@ def plot_single_histogram(ax, data, subject_value, title, xlabel, make_plots=Tru
     # Create histogram bins to determine boundaries
     histogram = np.histogram(data, 8)
     hist_bins = histogram[1]
-    _, q1, left_bord, _, q2, _, right_bord, q3, _ = hist_bins
     
     if make_plots:
-        # Create histogram plot
-        ax.hist(data, 8, edgecolor='black', facecolor='lightgrey')
-        
-        # Set labels
-        ax.set_xlabel(xlabel, fontsize=26)
-        ax.set_ylabel('Число детей', fontsize=26)
-        
-        # Add vertical lines for group boundaries
-        ax.axvline(left_bord, color='red', linewidth=4)
-        ax.axvline(right_bord, color='red', linewidth=4)
-        
-        # Set up twin axis for group labels
-        ax2 = ax.twiny()
-        xmin, xmax = np.percentile(data, [0, 100])
-        ax.set_xlim([xmin, xmax])
-        ax2.set_xlim([xmin, xmax])
-        
-        # Add group labels
-        labels_position = [q1, q2, q3]
-        labels = ['A', 'B', 'C']
-        ax2.set_xticks(labels_position)
-        ax2.set_xticklabels(labels)
+        draw_histogram_background(ax, data, histogram, xlabel)
         
         # Add subject marker and title
         if subject_value is not None:
-            bar_index = np.digitize(subject_value, histogram[1][:-1], right=True) - 1
-            bar_height = histogram[0][bar_index]
-            ax.plot(subject_value, bar_height/4, 'D', color='black', markersize=20)
-            
-            group = determine_group(subject_value, hist_bins)
-            ax.set_title(f"{title} {subject_value:.2f}\nРезультат - группа {group}", fontsize=30)
+            group, _ = draw_subject_marker(ax, histogram, subject_value, title)
             return group
             
         ax.set_title(title, fontsize=30)
@@ -64,24 +88,34 @@ def plot_single_histogram(ax, data, subject_value, title, xlabel, make_plots=Tru
         return determine_group(subject_value, hist_bins)
     return None
 
+FIGSIZE = (20, 14)
+
+MISSING_DATA_TEXT = "Отсутствуют данные прохождения теста"
+
+def plot_missing_data(figsize=FIGSIZE):
+    """Create a figure telling that the test data is missing"""
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=figsize)
+    ax.set_axis_off()
+    ax.text(0.5, 0.5, MISSING_DATA_TEXT,
+            horizontalalignment='center',
+            verticalalignment='center',
+            fontsize=40,
+            transform=ax.transAxes)
+    return fig
+
 def plot_histograms(subject_number, df, make_plots=True):
     """Create a 2x2 grid of histograms and return groups for each metric"""
+    import matplotlib.pyplot as plt
     subject_number = int(subject_number)
-    figsize = (20, 14)
+    figsize = FIGSIZE
     
     # Get subject data
     subject_data = df[df['subject'] == subject_number]
     
     if subject_data.empty:
         if make_plots:
-            fig, ax = plt.subplots(figsize=figsize)
-            ax.set_axis_off()
-            ax.text(0.5, 0.5, "Отсутствуют данные прохождения теста",
-                    horizontalalignment='center',
-                    verticalalignment='center',
-                    fontsize=40,
-                    transform=ax.transAxes)
-            return fig, {}, False
+            return plot_missing_data(figsize), {}, False
         return None, {}, False
     
     # Create figure only if plotting is needed
@@ -130,17 +164,360 @@ def plot_histograms(subject_number, df, make_plots=True):
     
     return fig, groups, True
 
-def create_histograms(test_name, subject_number, make_plots=True):
-    """Create and save histograms for a given subject"""
-    df = pd.read_csv(f"data/{test_name}7_modified.csv")
-    df['subject'] = df['subject'].astype(int)
+TESTS = ['CombFunction', 'MentalArithmetic', 'VisualSearch', 'WorkingMemory']
+
+# Group name -> metric column in the modified tables
+METRICS = {
+    'errors': 'error_percentage',
+    'time': 'response_time',
+    'exhaust': 'diff',
+    'attention': 'attention',
+}
+
+# Group name -> (title, xlabel) of its histogram
+METRIC_LABELS = {
+    'errors': ('Процент ошибок', 'Процент ошибок'),
+    'time': ('Время ответа', 'Время ответа (в секундах)'),
+    'exhaust': ('Уровень усталости', 'Усталость (условные единицы)'),
+    'attention': ('Уровень неустойчивости внимания', 'Неусточивость внимания (условные единицы)'),
+}
+
+GROUP_LABELS = np.array(['A', 'B', 'C'])
+
+class CohortStats:
+    """Cohort tables, histogram bins and A/B/C groups for all subjects
+
+    Every modified table is read once. Histogram edges are computed once per
+    test and metric, and all subjects are classified in one vectorized pass.
+    """
+
+    def __init__(self, tests=TESTS, path_template="data/{test}7_modified.csv", paths=None):
+        self.tests = list(tests)
+        self.tables = {}
+        self.histograms = {}
+        
+        for test in self.tests:
+            path = paths[test] if paths is not None else path_template.format(test=test)
+            df = data_cache.read_csv(path)
+            df['subject'] = df['subject'].astype(int)
+            self.tables[test] = df
+            
+            for metric, column in METRICS.items():
+                if column not in df:
+                    continue
+                data = df[column][pd.notna(df[column])]
+                self.histograms[(test, metric)] = np.histogram(data, 8)
+        
+        self.values = None
+        self.groups, self.present = self._classify()
+        self._renderers = {}
+
+    def _classify(self):
+        """Build the subject x (test, metric) group matrix"""
+        subjects = np.unique(np.concatenate([df['subject'].values for df in self.tables.values()]))
+        keys = list(self.histograms)
+        values = np.full((len(subjects), len(keys)), np.nan)
+        boundaries = np.empty((2, len(keys)))
+        present = pd.DataFrame(False, index=subjects, columns=self.tests)
+        
+        for i, (test, metric) in enumerate(keys):
+            # Subject values come from the first row of each subject, like in plot_histograms
+            df = self.tables[test].drop_duplicates('subject')
+            column = df.set_index('subject')[METRICS[metric]]
+            values[:, i] = column.reindex(subjects).values
+            hist_bins = self.histograms[(test, metric)][1]
+            boundaries[:, i] = hist_bins[2], hist_bins[6]
+        
+        for test, df in self.tables.items():
+            present[test] = present.index.isin(df['subject'])
+        
+        # Same as np.digitize(value, [left_bord, right_bord], right=True) for every column
+        group_index = (values > boundaries[0]).astype(int) + (values > boundaries[1])
+        groups = np.where(np.isnan(values), None, GROUP_LABELS[group_index])
+        columns = pd.MultiIndex.from_tuples(keys, names=['test', 'metric'])
+        self.values = pd.DataFrame(values, index=subjects, columns=columns)
+        return pd.DataFrame(groups, index=subjects, columns=columns), present
+
+    def subject_groups(self, test_name, subject_number):
+        """Return groups dict and data presence flag for a single subject"""
+        subject_number = int(subject_number)
+        if subject_number not in self.present.index or not self.present.at[subject_number, test_name]:
+            return {}, False
+        
+        row = self.groups.loc[subject_number, test_name]
+        return {metric: group for metric, group in row.items() if group is not None}, True
+
+    def __getstate__(self):
+        # Figures are rebuilt on demand after unpickling
+        state = self.__dict__.copy()
+        state['_renderers'] = {}
+        return state
+
+    def save(self, path):
+        """Write the statistics to a pickle, so other machines classify subjects identically"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def histogram_renderer(self, test_name):
+        """Return the cached histogram figure of a test
+
+        Only the figures of one cohort stay open in a process: rendering for
+        another cohort closes the figures of the previous one.
+        """
+        global _rendering_cohort
+        if _rendering_cohort is not self:
+            if _rendering_cohort is not None:
+                _rendering_cohort.close()
+            _rendering_cohort = self
+        if test_name not in self._renderers:
+            self._renderers[test_name] = HistogramRenderer(self, test_name)
+        return self._renderers[test_name]
+
+    def close(self):
+        """Release the histogram figures and their canvases, they are rebuilt when needed again"""
+        global _rendering_cohort
+        for renderer in self._renderers.values():
+            renderer.close()
+        self._renderers = {}
+        if _rendering_cohort is self:
+            _rendering_cohort = None
+
+# Cohort statistics whose histogram figures are open in this process
+_rendering_cohort = None
+
+class HistogramRenderer:
+    """2x2 cohort histogram figure of a test, drawn once and reused for every subject
+
+    Only the subject markers, titles and the visibility of metrics without a
+    subject value change between subjects. For PNGs the cohort background
+    is rendered and compressed once per dpi. Each subject then only restores
+    the rows under its titles, markers and hidden metrics, draws over them
+    and compresses those rows again. PDFs are saved whole.
+    """
+
+    def __init__(self, cohort, test_name):
+        import matplotlib
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        self.cohort = cohort
+        self.test_name = test_name
+        
+        matplotlib.rcParams.update({'font.size': 26})
+        # Not a pyplot figure, so nothing else holds on to it and its canvas once the renderer is closed
+        self.fig = Figure(figsize=FIGSIZE)
+        FigureCanvasAgg(self.fig)
+        axes = self.fig.subplots(2, 2)
+        self.axes = {}
+        
+        for metric, ax in zip(METRICS, axes.flat):
+            histogram = cohort.histograms.get((test_name, metric))
+            if histogram is None:
+                ax.set_visible(False)
+                continue
+            
+            column = cohort.tables[test_name][METRICS[metric]]
+            title, xlabel = METRIC_LABELS[metric]
+            twin = draw_histogram_background(ax, column[pd.notna(column)], histogram, xlabel)
+            # Markers and titles are animated: left out when the background is drawn, drawn per subject
+            marker, = ax.plot([], [], 'D', color='black', markersize=20, animated=True)
+            self.axes[metric] = (ax, twin, marker)
+            # Lay out with the widest title a subject of the cohort can get
+            values = cohort.values[(test_name, metric)].dropna()
+            widest = max((f"{value:.2f}" for value in values), key=len, default="0.00")
+            ax.set_title(subject_title(title, widest, 'A'), fontsize=30)
+        
+        self.fig.tight_layout()
+        # Same crop for every subject, like savefig(bbox_inches='tight') with the widest titles
+        self.bbox_inches = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(0.1)
+        for ax, _, _ in self.axes.values():
+            ax.title.set_animated(True)
+        # dpi -> (BandedPNG of the background, crop slices, blank regions of metrics)
+        self._backgrounds = {}
+
+    def _set_overlay(self, subject_number):
+        """Place the subject markers and titles, return metrics with and without a subject value"""
+        shown, hidden = [], []
+        for metric, (ax, _, marker) in self.axes.items():
+            key = (self.test_name, metric)
+            value = self.cohort.values.at[subject_number, key]
+            if np.isnan(value):
+                hidden.append(metric)
+                continue
+            
+            histogram = self.cohort.histograms[key]
+            marker.set_data([value], [subject_marker_height(histogram, value)])
+            group = determine_group(value, histogram[1])
+            ax.title.set_text(subject_title(METRIC_LABELS[metric][0], f"{value:.2f}", group))
+            shown.append(metric)
+        return shown, hidden
+
+    def _background(self, dpi):
+        if dpi not in self._backgrounds:
+            from banded_png import BandedPNG
+            self.fig.set_dpi(dpi)
+            canvas = self.fig.canvas
+            canvas.draw()
+            renderer = canvas.get_renderer()
+            height = self.fig.bbox.height
+            
+            def pixel_rows(bbox):
+                return slice(max(int(np.floor(height - bbox.y1)), 0), int(np.ceil(height - bbox.y0)))
+            
+            def pixel_columns(bbox):
+                return slice(max(int(np.floor(bbox.x0)), 0), int(np.ceil(bbox.x1)))
+            
+            bbox = self.bbox_inches.transformed(self.fig.dpi_scale_trans)
+            crop = (pixel_rows(bbox), pixel_columns(bbox))
+            background = np.asarray(canvas.buffer_rgba())[crop]
+            
+            # Area of each metric, including labels and ticks, blanked when the subject has no value
+            regions = {}
+            for metric, (ax, twin, _) in self.axes.items():
+                # Spines reach half their width past the tight box
+                area = type(bbox).union([ax.get_tightbbox(renderer), twin.get_tightbbox(renderer)]).padded(0.05 * dpi)
+                rows, columns = pixel_rows(area), pixel_columns(area)
+                regions[metric] = (slice(rows.start - crop[0].start, rows.stop - crop[0].start),
+                                   slice(columns.start - crop[1].start, columns.stop - crop[1].start))
+            self._backgrounds[dpi] = (BandedPNG(background, dpi), crop, regions)
+        return self._backgrounds[dpi]
+
+    def _save_png(self, subject_number, path, dpi):
+        encoder, crop, regions = self._background(dpi)
+        shown, hidden = self._set_overlay(subject_number)
+        
+        self.fig.set_dpi(dpi)
+        canvas = self.fig.canvas
+        renderer = canvas.get_renderer()
+        image = np.asarray(canvas.buffer_rgba())[crop]
+        height = self.fig.bbox.height
+        
+        # Image rows changed by the overlay. Line extents leave out part of the
+        # diamond marker, so the margin is a whole marker size.
+        spans = [(regions[metric][0].start, regions[metric][0].stop) for metric in hidden]
+        overlay = []
+        for metric in shown:
+            ax, _, marker = self.axes[metric]
+            margin = int(np.ceil(marker.get_markersize() * dpi / 72))
+            for artist in (marker, ax.title):
+                extent = artist.get_window_extent(renderer)
+                spans.append((int(height - extent.y1) - margin - crop[0].start,
+                              int(height - extent.y0) + margin - crop[0].start))
+                overlay.append((ax, artist))
+        changed = set()
+        for start, stop in spans:
+            start, stop = max(start, 0), min(stop, encoder.height)
+            if start < stop:
+                changed.update(range(encoder.band_of(start), encoder.band_of(stop - 1) + 1))
+        
+        for band in changed:
+            start = band * encoder.band_rows
+            image[start:start + encoder.band_rows] = encoder.background_rows(band)
+        for metric in hidden:
+            image[regions[metric]] = 255
+        for ax, artist in overlay:
+            ax.draw_artist(artist)
+        
+        with open(path, 'wb') as f:
+            f.write(encoder.encode(image, changed))
+
+    def close(self):
+        # The figure and canvas reference each other, break the cycle to free the pixel buffer now
+        self.fig.clear()
+        self.fig.canvas = None
+        self.fig = None
+        self.axes = {}
+        self._backgrounds = {}
+
+    def save(self, subject_number, path, dpi=DEFAULT_DPI):
+        """Draw the subject overlay and save the figure
+
+        The format follows the path extension, dpi only matters for PNG.
+        """
+        subject_number = int(subject_number)
+        if path.endswith('.png'):
+            self._save_png(subject_number, path, dpi)
+            return
+        
+        _, hidden = self._set_overlay(subject_number)
+        overlay = [artist for metric, (ax, _, marker) in self.axes.items() if metric not in hidden
+                   for artist in (marker, ax.title)]
+        for metric, (ax, twin, _) in self.axes.items():
+            ax.set_visible(metric not in hidden)
+            twin.set_visible(metric not in hidden)
+        for artist in overlay:
+            artist.set_animated(False)
+        try:
+            self.fig.savefig(path, dpi=dpi, bbox_inches=self.bbox_inches, metadata=figure_metadata(path))
+        finally:
+            for artist in overlay:
+                artist.set_animated(True)
+            for ax, twin, _ in self.axes.values():
+                ax.set_visible(True)
+                twin.set_visible(True)
+
+def figure_metadata(path):
+    """Leave out the creation date of PDFs, so unchanged figures give identical files"""
+    return {'CreationDate': None} if path.endswith('.pdf') else None
+
+# Encoded missing data figure for every (format, dpi)
+_missing_data_figures = {}
+
+def save_missing_data(path, dpi=DEFAULT_DPI):
+    """Link the missing data figure to path, rendering it only once per format"""
+    import matplotlib.pyplot as plt
+    figure_format = os.path.splitext(path)[1][1:]
+    key = (figure_format, dpi)
+    if key not in _missing_data_figures:
+        fig = plot_missing_data()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=figure_format, dpi=dpi, bbox_inches='tight', metadata=figure_metadata(path))
+        plt.close(fig)
+        _missing_data_figures[key] = buffer.getvalue()
     
-    # Create plots and get groups
-    fig, groups, is_existing_data = plot_histograms(subject_number, df, make_plots)
+    store = get_store()
+    store.link(store.put_bytes(_missing_data_figures[key], f'.{figure_format}'), path)
+
+_default_cohort = None
+
+def get_cohort():
+    """Return the cohort statistics shared by create_histograms calls"""
+    global _default_cohort
+    if _default_cohort is None:
+        _default_cohort = CohortStats()
+    return _default_cohort
+
+def create_histograms(test_name, subject_number, make_plots=True, cohort=None, subject_dir=None,
+                      figure_format=DEFAULT_FIGURE_FORMAT, dpi=DEFAULT_DPI):
+    """Create and save histograms for a given subject into subject_dir (subjects/<subject> by default)
+
+    figure_format is 'png' or 'pdf'. The template includes the figures without
+    extension, so a figure left in the other format is removed. The previous
+    figure is removed before saving too, it may be a link into the artifact store.
+    """
+    if cohort is None:
+        cohort = get_cohort()
     
-    # Save the figure only if plots were created
-    if make_plots and fig is not None:
-        fig.savefig(f'subjects/{subject_number}/{test_name}.png', dpi=300, bbox_inches='tight')
-        plt.close(fig)
+    groups, is_existing_data = cohort.subject_groups(test_name, subject_number)
+    if not make_plots:
+        return groups, is_existing_data
+    
+    # Draw the subject over the cached cohort histograms
+    if subject_dir is None:
+        subject_dir = f'subjects/{subject_number}'
+    path = f'{subject_dir}/{test_name}.{figure_format}'
+    for old_format in FIGURE_FORMATS:
+        if os.path.exists(f'{subject_dir}/{test_name}.{old_format}'):
+            os.remove(f'{subject_dir}/{test_name}.{old_format}')
+    if is_existing_data:
+        cohort.histogram_renderer(test_name).save(subject_number, path, dpi)
+    else:
+        save_missing_data(path, dpi)
     
     return groups, is_existing_data
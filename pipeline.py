@@ -0,0 +1,141 @@
+import asyncio
+import time
+from report_options import DEFAULT_LATEX_JOBS, DEFAULT_QUEUE_SIZE
+
+
+class QueueMonitor:
+    """Bounded asyncio queue that records its depth over time and the waits on both ends"""
+
+    def __init__(self, size):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.started = self.changed = time.perf_counter()
+        # Seconds spent at each depth, 0 to size
+        self.depth_seconds = [0.0] * (size + 1)
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def _record(self, previous_depth):
+        # Called right after a put or get, before any other task can run
+        now = time.perf_counter()
+        self.depth_seconds[previous_depth] += now - self.changed
+        self.changed = now
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def put(self, item):
+        """Put an item, waiting while the queue is full"""
+        started = time.perf_counter()
+        await self.queue.put(item)
+        self.put_wait += time.perf_counter() - started
+        self._record(self.queue.qsize() - 1)
+
+    async def get(self):
+        """Get an item, waiting while the queue is empty"""
+        started = time.perf_counter()
+        item = await self.queue.get()
+        self.get_wait += time.perf_counter() - started
+        self._record(self.queue.qsize() + 1)
+        return item
+
+    def stats(self):
+        self._record(self.queue.qsize())
+        elapsed = (self.changed - self.started) or 1.0
+        return {
+            'size': self.queue.maxsize,
+            'mean_depth': sum(depth * seconds for depth, seconds in enumerate(self.depth_seconds)) / elapsed,
+            'max_depth': self.max_depth,
+            'full': self.depth_seconds[-1] / elapsed,
+            'empty': self.depth_seconds[0] / elapsed,
+        }
+
+
+async def run_pipeline(items, prepare, compile, executor, prepare_jobs, compile_jobs=DEFAULT_LATEX_JOBS,
+                       queue_size=DEFAULT_QUEUE_SIZE, on_result=None):
+    """Run two stages over items at once, connected by a bounded queue
+
+    prepare_jobs tasks run prepare(item) in the executor and queue the
+    results; compile_jobs tasks take them off the queue and await
+    compile(result). While the second stage works on one subject the first
+    prepares the next ones. When the queue is full the first stage waits,
+    so at most queue_size prepared results wait for the second stage.
+    Results with an error are not compiled.
+    on_result is called with every finished result. An exception in either
+    stage or in on_result cancels both stages and is raised.
+
+    Returns:
+        Dict with wall time, stages (workers, items, busy seconds,
+        utilization and seconds waited on the queue) and queue statistics
+    """
+    loop = asyncio.get_running_loop()
+    queue = QueueMonitor(queue_size)
+    pending = iter(items)
+    stages = {'assets': {'workers': prepare_jobs, 'items': 0, 'busy': 0.0},
+              'tex': {'workers': compile_jobs, 'items': 0, 'busy': 0.0}}
+    started = time.perf_counter()
+
+    def finish(result):
+        if on_result is not None:
+            on_result(result)
+
+    async def prepare_worker():
+        # Tasks share the iterator, each takes the next item when it is free
+        for item in pending:
+            stage_started = time.perf_counter()
+            result = await loop.run_in_executor(executor, prepare, item)
+            stages['assets']['busy'] += time.perf_counter() - stage_started
+            stages['assets']['items'] += 1
+            if result['error'] is None:
+                await queue.put(result)
+            else:
+                finish(result)
+
+    async def compile_worker():
+        while True:
+            result = await queue.get()
+            if result is None:
+                return
+            stage_started = time.perf_counter()
+            result = await compile(result)
+            stages['tex']['busy'] += time.perf_counter() - stage_started
+            stages['tex']['items'] += 1
+            finish(result)
+
+    async def close_queue(preparers):
+        # Once every subject is prepared, one None per compile worker ends the second stage
+        await asyncio.gather(*preparers)
+        stats['queue'] = queue.stats()
+        for _ in range(compile_jobs):
+            await queue.put(None)
+
+    stats = {}
+    preparers = [asyncio.create_task(prepare_worker()) for _ in range(prepare_jobs)]
+    compilers = [asyncio.create_task(compile_worker()) for _ in range(compile_jobs)]
+    tasks = preparers + compilers + [asyncio.create_task(close_queue(preparers))]
+    # A failing task would leave the others waiting on the queue forever, so the first failure stops them all
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+    wall = time.perf_counter() - started
+    for stage_stats in stages.values():
+        stage_stats['utilization'] = stage_stats['busy'] / (wall * stage_stats['workers']) if wall else 0.0
+    # Seconds the first stage was held back by a full queue and the second stage idled on an empty one
+    stages['assets']['blocked'] = queue.put_wait
+    stages['tex']['starved'] = queue.get_wait
+    return dict(stats, wall=wall, stages=stages)
+
+
+def print_pipeline_stats(stats):
+    print(f"Pipeline finished in {stats['wall']:.1f} s")
+    for name, stage_stats in stats['stages'].items():
+        waited = (f"{stage_stats['blocked']:.1f} s blocked on a full queue" if 'blocked' in stage_stats
+                  else f"{stage_stats['starved']:.1f} s waiting for input")
+        print(f"  {name:<8}{stage_stats['workers']:>3} workers{stage_stats['items']:>6} subjects"
+              f"{stage_stats['busy']:>9.1f} s busy{stage_stats['utilization']:>6.0%} utilization, {waited}")
+    queue = stats['queue']
+    print(f"  queue   depth {queue['mean_depth']:.1f} on average, {queue['max_depth']} of {queue['size']} at most, "
+          f"full {queue['full']:.0%} and empty {queue['empty']:.0%} of the time")
@@ -1,99 +1,178 @@
+import argparse
+import json
+import os
 import pandas as pd
+import data_cache
+from cohorts import DEFAULT_COHORT, load_cohorts
+from quantile_sketch import QuantileSketch
 
 columns = ['freq', 'task', 'sub', 'block', 'Fp1', 'Fz', 'F3', 'F7', 'FT9', 'FC5', 'FC1', 'C3', 'T7', 'TP9', 'CP5', 'CP1', 'Pz', 'P3', 'P7', 'O1', 'Oz', 'O2', 'P4', 'P8', 'TP10', 'CP6', 'CP2', 'Cz', 'C4', 'T8', 'FT10', 'FC6', 'FC2', 'F4', 'F8', 'Fp2', 'AF7', 'AF3', 'AFz', 'F1', 'F5', 'FT7', 'FC3', 'C1', 'C5', 'TP7', 'CP3', 'P1', 'P5', 'PO7', 'PO3', 'POz', 'PO4', 'PO8', 'P6', 'P2', 'CPz', 'CP4', 'TP8', 'C6', 'C2', 'FC4', 'FT8', 'F6', 'AF8', 'AF4', 'F2', 'Iz']
 
 freq_unique = ['Alpha', 'Beta', 'Delta', 'Theta']
 task_unique = ['В', 'К', 'М', 'Р']
 block_unique = [1, 2, 3]
-df_path = 'data/norm_var_7class.csv'
 
-exhaust_df_path = 'data/Class7Fatigue.csv'
-
-# Add file paths for all tables
-input_files = {
-    'К': 'data/CombFunction7.csv',
-    'В': 'data/VisualSearch7.csv',
-    'Р': 'data/WorkingMemory7.csv',
-    'М': 'data/MentalArithmetic7.csv'
+# Task letter of the norm table for every test table
+task_letters = {
+    'К': 'CombFunction',
+    'В': 'VisualSearch',
+    'Р': 'WorkingMemory',
+    'М': 'MentalArithmetic'
 }
 
-def get_attention_value(norm_df, subject, task):
-    """Get attention value for specific subject and task"""
-    try:
-        # Convert subject from 7XX to XX format
-        orig_subject = int(str(subject)[1:])
-        
-        # Filter base conditions (Alpha band, block 1, current task)
-        base_conditions = (
-            (norm_df['freq'] == 'Alpha') & 
-            (norm_df['block'] == 1) & 
-            (norm_df['task'] == task)
+ATTENTION_CHANNELS = ['F6', 'F4', 'F8', 'FC6']
+ATTENTION_QUANTILE = 0.9
+
+# Rows of the norm table read at a time in streaming mode
+NORM_CHUNK_ROWS = 500_000
+
+def get_attention_thresholds(base_df):
+    """Get 90th percentile of every attention channel for each task"""
+    return base_df.groupby('task', observed=True)[ATTENTION_CHANNELS].quantile(ATTENTION_QUANTILE)
+
+def stream_norm_table(cohort, subjects, chunksize=NORM_CHUNK_ROWS, sketch=True):
+    """Read the norm table in chunks, keeping only what the attention values need
+
+    Of the Alpha, block 1 rows every task and attention channel feeds a
+    quantile sketch, and the first row of each subject in subjects is kept.
+    Memory does not grow with the size of the table.
+
+    Returns:
+        Thresholds like get_attention_thresholds (None without sketch), base rows of the subjects and sketch info
+    """
+    sketches = {}
+    base_parts = []
+    rows = 0
+    seen = pd.MultiIndex.from_arrays([[], []], names=['task', 'subject_id'])
+    reader = pd.read_csv(cohort.norm_path, usecols=['freq', 'task', 'sub', 'block'] + ATTENTION_CHANNELS,
+                         dtype={channel: 'float32' for channel in ATTENTION_CHANNELS}, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk.loc[(chunk['freq'] == 'Alpha') & (chunk['block'] == 1)]
+        rows += len(chunk)
+        if sketch:
+            for task, group in chunk.groupby('task'):
+                for channel in ATTENTION_CHANNELS:
+                    sketches.setdefault((task, channel), QuantileSketch()).update(group[channel].values)
+
+        chunk = chunk.assign(subject_id=(cohort.subject_prefix + chunk['sub'].astype(str).str.zfill(2)).astype(int))
+        chunk = chunk.loc[chunk['subject_id'].isin(subjects)].drop_duplicates(['task', 'subject_id'])
+        keys = pd.MultiIndex.from_frame(chunk[['task', 'subject_id']])
+        chunk = chunk.loc[~keys.isin(seen)]
+        seen = seen.append(pd.MultiIndex.from_frame(chunk[['task', 'subject_id']]))
+        base_parts.append(chunk)
+
+    base_df = pd.concat(base_parts, ignore_index=True)
+    if not sketch:
+        return None, base_df, {}
+
+    tasks = sorted({task for task, _ in sketches})
+    thresholds = pd.DataFrame([[sketches[(task, channel)].quantile(ATTENTION_QUANTILE) for channel in ATTENTION_CHANNELS]
+                               for task in tasks], index=pd.Index(tasks, name='task'), columns=ATTENTION_CHANNELS)
+    info = {'rows': rows, 'exact': all(sketch.exact for sketch in sketches.values())}
+    return thresholds, base_df, info
+
+def thresholds_path(cohort):
+    return cohort.norm_path.replace('.csv', '_thresholds.json')
+
+def save_thresholds(path, thresholds, source, **info):
+    """Save attention thresholds with the norm table they came from, for reuse by other cohorts"""
+    artifact = dict(info, source=source, quantile=ATTENTION_QUANTILE, channels=ATTENTION_CHANNELS,
+                    thresholds={task: row.tolist() for task, row in thresholds.iterrows()})
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def load_thresholds(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        artifact = json.load(f)
+    return pd.DataFrame.from_dict(artifact['thresholds'], orient='index', columns=artifact['channels']).rename_axis('task')
+
+def get_attention_values(base_df, thresholds, task):
+    """Get attention value for every subject of a task, indexed by subject_id
+
+    F6 is used when it does not exceed its 90th percentile, otherwise the
+    first of F4, F8, FC6 that does. Subjects with all channels above their
+    percentiles get NaN.
+    """
+    task_df = base_df.loc[base_df['task'] == task]
+    task_df = task_df.drop_duplicates('subject_id').set_index('subject_id')
+    channels = task_df[ATTENTION_CHANNELS]
+
+    if task not in thresholds.index:
+        return pd.Series(index=channels.index, dtype=float)
+
+    below = channels.le(thresholds.loc[task])
+    # First channel (in ATTENTION_CHANNELS order) that is under its threshold
+    return channels.where(below).bfill(axis=1).iloc[:, 0]
+
+def process_tables(cohort=DEFAULT_COHORT, streaming=False, chunksize=NORM_CHUNK_ROWS, reference_thresholds=None):
+    """Add error percentage, fatigue and attention columns to the test tables of a cohort
+
+    Attention thresholds come from the cohort's own norm table and are saved
+    next to it as <norm table>_thresholds.json, unless reference_thresholds
+    names such a file to use instead. With streaming the norm table is read
+    in chunks of chunksize rows.
+    """
+    # Read source dataframes
+    exhaust_df = data_cache.read_csv(cohort.fatigue_path)
+    test_dfs = {test_name: data_cache.read_csv(cohort.test_paths[test_name]) for test_name in task_letters.values()}
+    
+    if streaming:
+        subjects = pd.concat([df['subject'] for df in test_dfs.values()]).unique()
+        thresholds, base_df, info = stream_norm_table(cohort, subjects, chunksize, sketch=reference_thresholds is None)
+    else:
+        norm_df = data_cache.read_csv(
+            cohort.norm_path,
+            columns=['freq', 'task', 'sub', 'block'] + ATTENTION_CHANNELS,
+            categories=['freq', 'task'],
+            float32=columns[4:],
         )
         
-        # Get all values for these conditions to calculate percentiles
-        base_filtered = norm_df.loc[base_conditions]
-        
-        # Calculate 90th percentile for each channel we might need
-        channels = ['F6', 'F4', 'F8', 'FC6']
-        percentiles = {
-            channel: base_filtered[channel].quantile(0.9)
-            for channel in channels
-        }
-        
-        # Get subject's specific row
-        subject_conditions = base_conditions & (norm_df['sub'] == orig_subject)
-        subject_row = norm_df.loc[subject_conditions]
+        # Convert sub column in norm_df to <prefix>XX format (7XX for class 7) and create subject_id column
+        norm_df['subject_id'] = (cohort.subject_prefix + norm_df['sub'].astype(str).str.zfill(2)).astype(int)
         
-        if subject_row.empty:
-            return None
-            
-        # Check F6 first
-        if subject_row['F6'].iloc[0] <= percentiles['F6']:
-            return subject_row['F6'].iloc[0]
-            
-        # If F6 exceeds 90th percentile, try alternative channels
-        for alt_channel in ['F4', 'F8', 'FC6']:
-            if subject_row[alt_channel].iloc[0] <= percentiles[alt_channel]:
-                return subject_row[alt_channel].iloc[0]
-        
-        # If all channels exceed their 90th percentiles, return None
-        return None
-        
-    except Exception as e:
-        print(f"Error processing subject {subject} for task {task}: {str(e)}")
-        return None
-
-def process_tables():
-    # Read source dataframes
-    exhaust_df = pd.read_csv(exhaust_df_path)
-    norm_df = pd.read_csv(df_path)
+        # Base conditions for attention (Alpha band, block 1)
+        base_df = norm_df.loc[(norm_df['freq'] == 'Alpha') & (norm_df['block'] == 1)]
+        thresholds = get_attention_thresholds(base_df)
+        info = {'rows': len(base_df), 'exact': True}
     
-    # Convert sub column in norm_df to 7XX format and create subject_id column
-    norm_df['subject_id'] = norm_df['sub'].apply(lambda x: int(f"7{x:02d}"))
+    if reference_thresholds is not None:
+        thresholds = load_thresholds(reference_thresholds)
+    else:
+        save_thresholds(thresholds_path(cohort), thresholds, cohort.norm_path, **info)
     
     # Set indexes for easier lookup
     exhaust_df.set_index('subject', inplace=True)
     
     # Process each input file
-    for task_letter, file_path in input_files.items():
-        # Read input table
-        df = pd.read_csv(file_path)
+    for task_letter, test_name in task_letters.items():
+        df = test_dfs[test_name]
         
         # Add diff column from exhaust_df using index
-        df['diff'] = df['subject'].apply(
-            lambda x: exhaust_df.loc[x, 'diff'] if x in exhaust_df.index else None
-        )
+        df = df.join(exhaust_df['diff'], on='subject')
         
         df['error_percentage'] = (1 - df['answer']) * 100
         
         # Add attention column
-        df['attention'] = df['subject'].apply(
-            lambda x: get_attention_value(norm_df, x, task_letter)
-        )
+        attention = get_attention_values(base_df, thresholds, task_letter)
+        df['attention'] = df['subject'].map(attention)
         
         # Save modified table
-        output_path = file_path.replace('.csv', '_modified.csv')
-        df.to_csv(output_path, index=False)
+        df.to_csv(cohort.modified_path(test_name), index=False)
 
 if __name__ == "__main__":
-    process_tables()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Preprocess the test tables of one or more cohorts")
+    parser.add_argument('--cohorts', metavar='CONFIG',
+                        help="JSON file listing the cohorts (default: class 7 in data/)")
+    parser.add_argument('--streaming', action='store_true',
+                        help="read the norm table in chunks, with constant memory whatever its size")
+    parser.add_argument('--chunk-rows', type=int, default=NORM_CHUNK_ROWS,
+                        help=f"norm table rows per chunk in streaming mode (default: {NORM_CHUNK_ROWS})")
+    parser.add_argument('--thresholds', metavar='PATH',
+                        help="use attention thresholds saved from a reference norm table instead of the cohort's own")
+    args = parser.parse_args()
+
+    for cohort in load_cohorts(args.cohorts) if args.cohorts else [DEFAULT_COHORT]:
+        print(f"Preprocessing cohort {cohort.name}")
+        process_tables(cohort, args.streaming, args.chunk_rows, args.thresholds)
@@ -0,0 +1,95 @@
+import numpy as np
+
+# Values kept exactly before a sketch starts compacting, 512 KB of float64.
+# The norm table feeds 16 sketches (4 tasks x 4 channels), 8 MB at most.
+EXACT_LIMIT = 65_536
+# Values per compactor level once compacting
+COMPACTOR_CAPACITY = 8192
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of a stream of numbers
+
+    Up to exact_limit values are kept as they are and quantiles match
+    np.quantile with linear interpolation (like pandas). Beyond that the
+    values go through a hierarchy of compactors in the manner of KLL: a full
+    level is sorted and every other value, from a random offset, moves up a
+    level with twice the weight. The rank error stays around
+    n * log2(n / capacity) / capacity, while memory grows only with
+    log2(n / capacity) levels of capacity values.
+    """
+
+    def __init__(self, exact_limit=EXACT_LIMIT, capacity=COMPACTOR_CAPACITY, seed=0):
+        self.exact_limit = exact_limit
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        # Level h holds values of weight 2**h, in exact mode there is only level 0
+        self.levels = [[]]
+        self.exact = True
+
+    def update(self, values):
+        """Add an array of values, NaNs are skipped"""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.count += len(values)
+        self.levels[0].append(values)
+        if self.exact and self.count > self.exact_limit:
+            self.exact = False
+        if not self.exact:
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """Add the values summarized by another sketch"""
+        self.count += other.count
+        for level, arrays in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append([])
+            self.levels[level].extend(arrays)
+        if self.exact and (not other.exact or self.count > self.exact_limit):
+            self.exact = False
+        if not self.exact:
+            self._compress()
+        return self
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = np.concatenate(self.levels[level]) if self.levels[level] else np.empty(0)
+            if len(values) <= self.capacity:
+                self.levels[level] = [values]
+                level += 1
+                continue
+
+            values.sort()
+            # An odd value out stays at this level, the rest is halved
+            keep = values[-1:] if len(values) % 2 else values[:0]
+            pairs = values[:len(values) - len(keep)]
+            promoted = pairs[self.rng.integers(2)::2]
+            self.levels[level] = [keep]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            self.levels[level + 1].append(promoted)
+            level += 1
+
+    def quantile(self, q):
+        """Value at quantile q, NaN for an empty sketch"""
+        if not self.count:
+            return np.nan
+        if self.exact:
+            return float(np.quantile(np.concatenate(self.levels[0]), q))
+
+        values = np.concatenate([np.concatenate(arrays) for arrays in self.levels if arrays])
+        weights = np.concatenate([np.full(sum(len(a) for a in arrays), 2.0 ** level)
+                                  for level, arrays in enumerate(self.levels) if arrays])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        index = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return float(values[order][min(index, len(values) - 1)])
+
+    def size(self):
+        """Number of values held in memory"""
+        return sum(len(array) for arrays in self.levels for array in arrays)
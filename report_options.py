@@ -0,0 +1,15 @@
+# Defaults of the report generation options, shared by the pipeline modules
+# and the command line entry points. Nothing heavy is imported here, so
+# reports.py --help starts without pandas or matplotlib.
+
+# Histograms are either vector PDFs or PNGs rendered at a given dpi
+FIGURE_FORMATS = ('png', 'pdf')
+DEFAULT_FIGURE_FORMAT = 'png'
+DEFAULT_DPI = 300
+
+# Engine runs at once and prepared subjects waiting for one in the pipelined scheduler
+DEFAULT_LATEX_JOBS = 2
+DEFAULT_QUEUE_SIZE = 4
+
+# Seconds a single engine run may take in the pipelined scheduler
+LATEX_TIMEOUT = 300
@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import data_cache
+import generate_recommendation
+import image_overlay
+from cohorts import DEFAULT_COHORT, load_cohorts
+from generate_recommendation import RECOMMENDATIONS_PATH
+from generate_texes import build_latex_format, get_subject_code, load_cohort_stats, load_context, read_text, run_subject
+from latex_format import ensure_format, prepare_template
+from report_options import DEFAULT_DPI, DEFAULT_FIGURE_FORMAT, FIGURE_FORMATS
+
+DEFAULT_PORT = 8765
+
+
+def context_inputs(cohorts):
+    """Input files of every part of the generation context, keyed by part"""
+    inputs = {
+        'templates': ["template.tex", "factors.tex"],
+        'recommendations': [RECOMMENDATIONS_PATH],
+        'iq_badges': [image_overlay.BASE_IMAGE_PATH, image_overlay.FONT_PATH],
+    }
+    for cohort in cohorts:
+        inputs[f"cohort:{cohort.name}"] = list(cohort.modified_paths().values())
+    return inputs
+
+
+def input_mtimes(paths):
+    return [os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths]
+
+
+class ContextWatcher:
+    """Generation context that reloads only the parts whose input files changed
+
+    The LaTeX format is only looked up, the server builds it before workers
+    need it.
+    """
+
+    def __init__(self, cohorts, context_options):
+        self.cohorts = {cohort.name: cohort for cohort in cohorts}
+        self.options = context_options
+        self.context = load_context(cohorts=cohorts, build_format=False, **context_options)
+        self.inputs = context_inputs(cohorts)
+        self.mtimes = {part: input_mtimes(paths) for part, paths in self.inputs.items()}
+
+    def refresh(self):
+        """Reload changed parts of the context and return their names"""
+        changed = []
+        for part, paths in self.inputs.items():
+            mtimes = input_mtimes(paths)
+            if mtimes != self.mtimes[part]:
+                self.reload(part)
+                self.mtimes[part] = mtimes
+                changed.append(part)
+        return changed
+
+    def reload(self, part):
+        if part == 'templates':
+            template = prepare_template(read_text("template.tex"))
+            self.context['template'] = template
+            self.context['factors_template'] = read_text("factors.tex")
+            if self.options.get('use_format', True):
+                self.context['latex_format'] = ensure_format(template, build=False)
+        elif part == 'recommendations':
+            generate_recommendation.load_recommendations.cache_clear()
+            generate_recommendation.render_recommendation_table.cache_clear()
+            generate_recommendation.load_recommendations()
+        elif part == 'iq_badges':
+            # The next badge is drawn by a renderer with the new image and font
+            image_overlay._renderer = None
+        else:
+            name = part.split(':', 1)[1]
+            # Release the histogram figures of the replaced statistics, nothing renders with them again
+            self.context['cohorts'][name].close()
+            self.context['cohorts'][name] = load_cohort_stats(self.cohorts[name])
+
+
+# Context of a server pool worker, loaded by _init_server_worker
+_watcher = None
+
+def _init_server_worker(cohorts, context_options):
+    global _watcher
+    _watcher = ContextWatcher(cohorts, context_options)
+
+def _render_in_worker(cohort, row):
+    reloaded = _watcher.refresh()
+    result = run_subject(row, _watcher.context, True, cohort)
+    result['reloaded'] = reloaded
+    return result
+
+
+class ReportServer:
+    """Rosters in memory and a pool of workers with warm generation contexts
+
+    Every request regenerates one subject. Rosters are re-read when their
+    files change, workers reload the changed parts of their contexts before
+    each subject. The LaTeX format is built here, once before the workers
+    start and again when the template changes, never by the workers.
+    """
+
+    def __init__(self, cohorts, jobs=1, **context_options):
+        self.cohorts = {cohort.name: cohort for cohort in cohorts}
+        self.default_cohort = cohorts[0].name
+        self.use_format = context_options.get('use_format', True)
+        self.template_mtimes = None
+        self.update_format()
+        self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_server_worker,
+                                        initargs=(cohorts, context_options))
+        # Start the workers now, so the first request finds them warm
+        for future in [self.pool.submit(time.sleep, 0) for _ in range(jobs)]:
+            future.result()
+
+        self.rosters = {}
+        self.roster_mtimes = {}
+        self.lock = threading.Lock()
+        self.subject_locks = {}
+        self.stats = {'requests': 0, 'generated': 0, 'failed': 0, 'reloads': {}}
+
+    def update_format(self):
+        """Build the LaTeX format if the template changed since the last build"""
+        mtimes = input_mtimes(["template.tex"])
+        if self.use_format and mtimes != self.template_mtimes:
+            build_latex_format()
+        self.template_mtimes = mtimes
+
+    def roster(self, cohort):
+        """{subject code: roster row} of a cohort, re-read if the roster file changed"""
+        mtime = os.stat(cohort.roster_path).st_mtime_ns
+        if self.roster_mtimes.get(cohort.name) != mtime:
+            df = data_cache.read_excel(cohort.roster_path, header=[0,1])
+            self.rosters[cohort.name] = {get_subject_code(row): row for _, row in df.iterrows()}
+            self.roster_mtimes[cohort.name] = mtime
+        return self.rosters[cohort.name]
+
+    def generate(self, cohort_name, subject_code):
+        """Regenerate a subject's report and return its result, or None for an unknown subject"""
+        cohort = self.cohorts.get(cohort_name)
+        with self.lock:
+            self.stats['requests'] += 1
+            # Before the worker sees the new template and looks for its format
+            self.update_format()
+            row = self.roster(cohort).get(subject_code) if cohort is not None else None
+            subject_lock = self.subject_locks.setdefault((cohort_name, subject_code), threading.Lock())
+        if row is None:
+            return None
+
+        # Concurrent requests for one subject would write the same directory
+        with subject_lock:
+            result = self.pool.submit(_render_in_worker, cohort, row).result()
+        with self.lock:
+            self.stats['generated' if result['ok'] else 'failed'] += 1
+            for part in result['reloaded']:
+                self.stats['reloads'][part] = self.stats['reloads'].get(part, 0) + 1
+        return result
+
+    def status(self):
+        with self.lock:
+            subjects = {name: len(self.roster(cohort)) for name, cohort in self.cohorts.items()}
+            return dict(self.stats, reloads=dict(self.stats['reloads']), subjects=subjects)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """GET /report?subject=CODE[&cohort=NAME] returns the regenerated PDF, GET /status the server counters
+
+    Without cohort the first configured cohort is used.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        report_server = self.server.report_server
+
+        if url.path == '/status':
+            self.send_json(200, report_server.status())
+            return
+        if url.path != '/report' or 'subject' not in query:
+            self.send_json(404, {'error': "use /report?subject=CODE[&cohort=NAME] or /status"})
+            return
+
+        started = time.perf_counter()
+        result = report_server.generate(query.get('cohort', report_server.default_cohort), query['subject'])
+        if result is None:
+            self.send_json(404, {'error': f"unknown subject {query['subject']}"})
+        elif not result['ok']:
+            self.send_json(500, {'error': result['error'], 'subject': result['subject']})
+        else:
+            with open(result['pdf'], 'rb') as f:
+                pdf = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(pdf)))
+            self.send_header('X-Generation-Seconds', f"{time.perf_counter() - started:.2f}")
+            self.end_headers()
+            self.wfile.write(pdf)
+
+    def send_json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(report_server, host='127.0.0.1', port=DEFAULT_PORT):
+    httpd = ThreadingHTTPServer((host, port), ReportRequestHandler)
+    httpd.report_server = report_server
+    print(f"Serving reports on http://{host}:{port}/report?subject=CODE")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        report_server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep inputs and workers in memory and regenerate single reports on request")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--jobs', '-j', type=int, default=2, help="number of warm workers (default: 2)")
+    parser.add_argument('--cohorts', metavar='CONFIG',
+                        help="JSON file listing the cohorts (default: class 7 in data/)")
+    parser.add_argument('--no-format-cache', dest='format_cache', action='store_false')
+    parser.add_argument('--figure-format', choices=FIGURE_FORMATS, default=DEFAULT_FIGURE_FORMAT)
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI)
+    args = parser.parse_args(argv)
+
+    cohorts = load_cohorts(args.cohorts) if args.cohorts else [DEFAULT_COHORT]
+    for cohort in cohorts:
+        os.makedirs(cohort.pdfs_dir, exist_ok=True)
+    report_server = ReportServer(cohorts, args.jobs, use_format=args.format_cache,
+                                 figure_format=args.figure_format, dpi=args.dpi)
+    serve(report_server, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import json
+from report_options import (DEFAULT_DPI, DEFAULT_FIGURE_FORMAT, DEFAULT_LATEX_JOBS, DEFAULT_QUEUE_SIZE,
+                            FIGURE_FORMATS, LATEX_TIMEOUT)
+
+STAGES = ['preprocess', 'classify', 'render', 'compile']
+
+# The functions of the stages are the library API: they return dicts and
+# import pandas, matplotlib and the rest only when the stage needs them.
+
+
+def get_cohorts(config=None, names=None):
+    """Cohorts of a JSON config (class 7 in data/ without one), optionally only those in names"""
+    from cohorts import DEFAULT_COHORT, load_cohorts
+
+    cohorts = load_cohorts(config) if config else [DEFAULT_COHORT]
+    if names:
+        unknown = set(names) - {cohort.name for cohort in cohorts}
+        if unknown:
+            raise ValueError(f"unknown cohorts: {sorted(unknown)}")
+        cohorts = [cohort for cohort in cohorts if cohort.name in names]
+    return cohorts
+
+
+def preprocess(cohorts=None, streaming=False, chunk_rows=None, thresholds=None):
+    """Write the modified test tables of every cohort
+
+    Returns:
+        Dicts with cohort, tables (test -> modified table path) and thresholds (path of the thresholds used)
+    """
+    import preprocess_eeg
+
+    results = []
+    for cohort in cohorts or get_cohorts():
+        preprocess_eeg.process_tables(cohort, streaming, chunk_rows or preprocess_eeg.NORM_CHUNK_ROWS, thresholds)
+        results.append({'cohort': cohort.name, 'tables': cohort.modified_paths(),
+                        'thresholds': thresholds or preprocess_eeg.thresholds_path(cohort)})
+    return results
+
+
+def classify(cohorts=None, subjects=None, stats_dir=None):
+    """Groups of every selected subject, without drawing anything
+
+    Returns:
+        Dicts with cohort, subject, name, groups ({test: {metric: group}} for
+        tests with data) and recomendations (tests that get recommendations)
+    """
+    from generate_texes import TASKS, get_subject_code, load_cohort_stats, needs_recommendation, select_rows
+
+    results = []
+    for cohort in cohorts or get_cohorts():
+        stats = load_cohort_stats(cohort, stats_dir)
+        for row in select_rows(cohort, subjects):
+            subject_code = get_subject_code(row)
+            result = {'cohort': cohort.name, 'subject': subject_code, 'name': row[('ФИО', 'Unnamed: 2_level_1')],
+                      'groups': {}, 'recomendations': []}
+            for test in TASKS:
+                groups, is_existing_data = stats.subject_groups(test, subject_code)
+                if is_existing_data:
+                    result['groups'][test] = groups
+                if needs_recommendation(groups, is_existing_data):
+                    result['recomendations'].append(test)
+            results.append(result)
+    return results
+
+
+def render(cohorts=None, subjects=None, **options):
+    """Generate histograms, images and tex files of the selected subjects, options as in generate_texes.build"""
+    from generate_texes import build
+    return build(cohorts or get_cohorts(), subjects, compile=False, **options)
+
+
+def compile_reports(cohorts=None, subjects=None, **options):
+    """Generate the PDF reports of the selected subjects, options as in generate_texes.build"""
+    from generate_texes import build
+    return build(cohorts or get_cohorts(), subjects, compile=True, **options)
+
+
+def print_classification(results):
+    for result in results:
+        groups = '  '.join(f"{test}:" + ''.join(groups.get(metric) or '-' for metric in ('errors', 'time', 'exhaust', 'attention'))
+                           for test, groups in result['groups'].items())
+        print(f"{result['cohort']}/{result['subject']:<8}{groups}  {','.join(result['recomendations'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EEG report pipeline, e.g. `reports.py classify --subjects 701 --json` "
+                                                 "or `reports.py compile -j 4 --dry-run`")
+    subparsers = parser.add_subparsers(dest='stage', required=True)
+    stage_parsers = {stage: subparsers.add_parser(stage) for stage in STAGES}
+
+    for stage, stage_parser in stage_parsers.items():
+        stage_parser.add_argument('--cohorts', metavar='CONFIG',
+                                  help="JSON file listing the cohorts (default: class 7 in data/)")
+        stage_parser.add_argument('--cohort', nargs='+', metavar='NAME', help="only these cohorts of the config")
+        if stage != 'preprocess':
+            stage_parser.add_argument('--subjects', nargs='+', metavar='CODE',
+                                      help="only subjects with these codes, COHORT/CODE selects one cohort's subject")
+            stage_parser.add_argument('--cohort-stats', metavar='DIR',
+                                      help="load cohort statistics saved by generate_texes.py --save-cohort-stats")
+        stage_parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+
+    stage_parsers['preprocess'].add_argument('--streaming', action='store_true')
+    stage_parsers['preprocess'].add_argument('--chunk-rows', type=int)
+    stage_parsers['preprocess'].add_argument('--thresholds', metavar='PATH')
+
+    for stage in ('render', 'compile'):
+        stage_parser = stage_parsers[stage]
+        stage_parser.add_argument('--jobs', '-j', type=int, default=1)
+        stage_parser.add_argument('--force', action='store_true', help="rebuild subjects with unchanged inputs")
+        stage_parser.add_argument('--dry-run', action='store_true', help="only list the subjects that would be rebuilt")
+        stage_parser.add_argument('--figure-format', choices=FIGURE_FORMATS, default=DEFAULT_FIGURE_FORMAT)
+        stage_parser.add_argument('--dpi', type=int, default=DEFAULT_DPI)
+    stage_parsers['compile'].add_argument('--batch-size', type=int, default=0)
+    stage_parsers['compile'].add_argument('--no-format-cache', dest='format_cache', action='store_false')
+    stage_parsers['compile'].add_argument('--pipeline', action='store_true',
+                                          help="prepare assets while earlier subjects are typeset")
+    stage_parsers['compile'].add_argument('--latex-jobs', type=int, default=DEFAULT_LATEX_JOBS)
+    stage_parsers['compile'].add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE)
+    stage_parsers['compile'].add_argument('--latex-timeout', type=float, default=LATEX_TIMEOUT)
+    stage_parsers['compile'].add_argument('--gc-store', action='store_true',
+                                          help="remove stored artifacts no subject links to any more")
+    stage_parsers['compile'].add_argument('--trace', metavar='PATH')
+    stage_parsers['compile'].add_argument('--size-report', metavar='PATH')
+    args = parser.parse_args(argv)
+
+    cohorts = get_cohorts(args.cohorts, args.cohort)
+    if args.stage == 'preprocess':
+        results = preprocess(cohorts, args.streaming, args.chunk_rows, args.thresholds)
+    elif args.stage == 'classify':
+        results = classify(cohorts, args.subjects, args.cohort_stats)
+        if not args.json:
+            print_classification(results)
+    else:
+        options = dict(force=args.force, dry_run=args.dry_run, jobs=args.jobs, figure_format=args.figure_format,
+                       dpi=args.dpi, stats_dir=args.cohort_stats)
+        if args.stage == 'compile':
+            options.update(batch_size=args.batch_size, use_format=args.format_cache, trace=args.trace,
+                           size_report=args.size_report, pipeline=args.pipeline, latex_jobs=args.latex_jobs,
+                           queue_size=args.queue_size, latex_timeout=args.latex_timeout, gc_store=args.gc_store)
+            results = compile_reports(cohorts, args.subjects, **options)
+        else:
+            results = render(cohorts, args.subjects, **options)
+        if args.dry_run and not args.json:
+            from generate_texes import print_plan
+            print_plan(results)
+
+    if args.json:
+        for result in results:
+            result = {key: value for key, value in result.items() if key != 'trace'}
+            print(json.dumps(result, ensure_ascii=False, default=str))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+SHARD_MANIFEST_DIR = "shards"
+
+# Outputs and caches of a run, not shared with simulated shards
+RUN_OUTPUTS = {'subjects', 'subjects_pdfs', SHARD_MANIFEST_DIR, '.cache', '.git'}
+
+
+def parse_shard(spec):
+    """Parse 'K/N' into (K, N) with 1 <= K <= N"""
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like K/N, got {spec!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def shard_of(cohort_name, subject_code, count):
+    """1-based shard of a subject, the same on every machine and Python version"""
+    key = f"{cohort_name}/{subject_code}".encode('utf-8')
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big') % count + 1
+
+
+def shard_manifest_path(index, count, root='.'):
+    return os.path.join(root, SHARD_MANIFEST_DIR, f"shard-{index}-of-{count}.json")
+
+
+def write_shard_manifest(path, index, count, entries):
+    """Write the outcome of every subject assigned to a shard
+
+    Entries are dicts with cohort, subject, name, status (ok, failed or
+    up_to_date), pdf and error. PDF paths are relative to the shard's
+    working directory.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'shard': index, 'count': count, 'subjects': entries}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def expected_subjects(cohorts, subjects=None):
+    """(cohort, code) of every roster row, selected like generate_texes --subjects"""
+    import data_cache
+    from generate_texes import get_subject_code
+
+    expected = set()
+    for cohort in cohorts:
+        df = data_cache.read_excel(cohort.roster_path, header=[0,1])
+        for _, row in df.iterrows():
+            code = get_subject_code(row)
+            if not subjects or code in subjects or f"{cohort.name}/{code}" in subjects:
+                expected.add((cohort.name, code))
+    return expected
+
+
+def merge_shards(shard_dirs, cohorts, output_dir='.', subjects=None):
+    """Copy the PDFs of all shards into output_dir and check every expected subject is there
+
+    Returns:
+        Dict with merged, failed and missing lists of (cohort, subject) and missing_shards
+    """
+    manifests = []
+    for shard_dir in shard_dirs:
+        manifest_dir = os.path.join(shard_dir, SHARD_MANIFEST_DIR)
+        for name in sorted(os.listdir(manifest_dir)) if os.path.isdir(manifest_dir) else []:
+            if name.endswith('.json'):
+                with open(os.path.join(manifest_dir, name), 'r', encoding='utf-8') as f:
+                    manifests.append((shard_dir, json.load(f)))
+
+    counts = {manifest['count'] for _, manifest in manifests}
+    if len(counts) > 1:
+        raise ValueError(f"shard manifests of different partitions: {sorted(counts)}")
+    count = counts.pop() if counts else 0
+    missing_shards = sorted(set(range(1, count + 1)) - {manifest['shard'] for _, manifest in manifests})
+
+    merged, failed = [], []
+    for shard_dir, manifest in manifests:
+        for entry in manifest['subjects']:
+            key = (entry['cohort'], entry['subject'])
+            source = os.path.join(shard_dir, entry['pdf']) if entry['pdf'] else None
+            if entry['status'] == 'failed' or source is None or not os.path.exists(source):
+                failed.append((key, entry['error'] or "PDF not found"))
+                continue
+
+            destination = os.path.join(output_dir, entry['pdf'])
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if not (os.path.exists(destination) and os.path.samefile(source, destination)):
+                shutil.copy2(source, destination)
+            merged.append(key)
+
+    reported = set(merged) | {key for key, _ in failed}
+    missing = sorted(expected_subjects(cohorts, subjects) - reported)
+    return {'merged': sorted(merged), 'failed': sorted(failed), 'missing': missing, 'missing_shards': missing_shards}
+
+
+def print_merge_report(report):
+    print(f"Merged {len(report['merged'])} PDFs, {len(report['failed'])} failed, {len(report['missing'])} missing")
+    if report['missing_shards']:
+        print(f"  no manifest from shards {report['missing_shards']}")
+    for (cohort, subject), error in report['failed']:
+        print(f"  failed {cohort}/{subject}: {error}")
+    for cohort, subject in report['missing']:
+        print(f"  missing {cohort}/{subject}")
+
+
+def simulate(count, root, generate_args, stats_dir=None):
+    """Run count shards as local processes, each in its own directory under root like separate machines
+
+    Inputs of the current directory are symlinked into every shard
+    directory, outputs and caches are not shared.
+
+    Returns:
+        List of shard directories
+    """
+    shard_dirs = []
+    for index in range(1, count + 1):
+        shard_dir = os.path.join(root, f"shard-{index}")
+        os.makedirs(shard_dir, exist_ok=True)
+        for name in os.listdir('.'):
+            link = os.path.join(shard_dir, name)
+            if name not in RUN_OUTPUTS and os.path.abspath(name) != os.path.abspath(root) \
+                    and not os.path.lexists(link):
+                os.symlink(os.path.abspath(name), link)
+        shard_dirs.append(shard_dir)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate_texes.py')
+    extra_args = ['--cohort-stats', os.path.abspath(stats_dir)] if stats_dir else []
+    processes = []
+    for index, shard_dir in enumerate(shard_dirs, start=1):
+        with open(os.path.join(shard_dir, 'shard.log'), 'w') as log:
+            processes.append(subprocess.Popen(
+                [sys.executable, script, '--shard', f"{index}/{count}"] + extra_args + generate_args,
+                cwd=shard_dir, stdout=log, stderr=subprocess.STDOUT))
+    for index, process in enumerate(processes, start=1):
+        if process.wait() != 0:
+            print(f"Shard {index}/{count} exited with code {process.returncode}, see {shard_dirs[index - 1]}/shard.log")
+    return shard_dirs
+
+
+def main(argv=None):
+    from cohorts import DEFAULT_COHORT, load_cohorts
+
+    # Arguments after -- go to generate_texes.py in simulated shards
+    argv = sys.argv[1:] if argv is None else list(argv)
+    generate_args = []
+    if '--' in argv:
+        generate_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description="Merge sharded report runs, or simulate them locally",
+                                     epilog="simulate passes arguments after -- to generate_texes.py")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    merge_parser = subparsers.add_parser('merge', help="collect PDFs of finished shards")
+    merge_parser.add_argument('shard_dirs', nargs='+', metavar='SHARD_DIR',
+                              help="working directories of the shards, with their shards/ manifests")
+
+    simulate_parser = subparsers.add_parser('simulate', help="run N shards as local processes and merge them")
+    simulate_parser.add_argument('count', type=int)
+    simulate_parser.add_argument('--root', default='shard_runs', help="directory for the shards (default: shard_runs)")
+    simulate_parser.add_argument('--precompute-stats', action='store_true',
+                                 help="classify the cohorts once and let every shard load the statistics")
+
+    for subparser in (merge_parser, simulate_parser):
+        subparser.add_argument('--cohorts', metavar='CONFIG')
+        subparser.add_argument('--subjects', nargs='+', metavar='CODE')
+        subparser.add_argument('--output', default='.', help="directory receiving subjects_pdfs/ (default: .)")
+    args = parser.parse_args(argv)
+
+    cohorts = load_cohorts(args.cohorts) if args.cohorts else [DEFAULT_COHORT]
+    if args.command == 'simulate':
+        if args.cohorts:
+            generate_args += ['--cohorts', os.path.abspath(args.cohorts)]
+        if args.subjects:
+            generate_args += ['--subjects'] + args.subjects
+
+        stats_dir = None
+        if args.precompute_stats:
+            import generate_texes
+            stats_dir = os.path.join(args.root, 'cohort_stats')
+            generate_texes.main(['--save-cohort-stats', stats_dir] +
+                                (['--cohorts', args.cohorts] if args.cohorts else []))
+        shard_dirs = simulate(args.count, args.root, generate_args, stats_dir)
+    else:
+        shard_dirs = args.shard_dirs
+
+    report = merge_shards(shard_dirs, cohorts, args.output, args.subjects)
+    print_merge_report(report)
+    return 0 if not (report['failed'] or report['missing'] or report['missing_shards']) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from preprocess_eeg import columns as EEG_COLUMNS, freq_unique, task_unique, block_unique
+from generate_recommendation import TASKS as RECOMMENDATION_TASKS
+from generate_texes import KETTEL_FACTORS
+
+# Roster columns before the Kettel factors, as (top header, second header)
+ROSTER_COLUMNS = [('код', None), ('класс', None), ('ФИО', None), ('пол', None), ('дата', None), ('IQ', None)]
+
+TEST_FILES = {
+    'CombFunction': 'CombFunction7.csv',
+    'VisualSearch': 'VisualSearch7.csv',
+    'WorkingMemory': 'WorkingMemory7.csv',
+    'MentalArithmetic': 'MentalArithmetic7.csv',
+}
+
+
+def subject_code(sub):
+    """Subject code the way preprocess_eeg derives it from the EEG `sub` number"""
+    return int(f"7{sub:02d}")
+
+
+def write_roster(path, subs, rng, missing_fraction=0.05):
+    """Write the roster xlsx with the two-level header: codes, names, IQ and Kettel factors"""
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    top = [name for name, _ in ROSTER_COLUMNS] + ['Кеттел'] + [None] * (len(KETTEL_FACTORS) - 1)
+    sheet.append(top)
+    sheet.append([None] * len(ROSTER_COLUMNS) + KETTEL_FACTORS)
+
+    for sub in subs:
+        iq = None if rng.random() < missing_fraction else int(rng.normal(100, 15))
+        if rng.random() < missing_fraction:
+            factors = [None] * len(KETTEL_FACTORS)
+        else:
+            factors = [int(value) for value in rng.integers(1, 11, len(KETTEL_FACTORS))]
+        code = subject_code(sub)
+        sheet.append([code, '7А', f"Ученик {code}", 'м' if sub % 2 else 'ж', '2024-10-14', iq] + factors)
+    workbook.save(path)
+
+
+def write_norm_table(path, subs, rng):
+    """Write the normative EEG table with every freq/task/block combination and all 64 channels"""
+    channels = EEG_COLUMNS[4:]
+    index = pd.MultiIndex.from_product([freq_unique, task_unique, subs, block_unique],
+                                       names=['freq', 'task', 'sub', 'block'])
+    values = rng.lognormal(0.0, 0.5, (len(index), len(channels))).astype(np.float32)
+    df = pd.DataFrame(values, index=index, columns=channels).reset_index()
+    df[EEG_COLUMNS].to_csv(path, index=False)
+
+
+def write_test_tables(data_dir, subs, rng, missing_fraction=0.03):
+    """Write the fatigue table and the four test tables"""
+    codes = np.array([subject_code(sub) for sub in subs])
+    pd.DataFrame({
+        'subject': codes,
+        'diff': rng.normal(0.0, 1.0, len(codes)),
+    }).to_csv(os.path.join(data_dir, 'Class7Fatigue.csv'), index=False)
+
+    for file_name in TEST_FILES.values():
+        tested = codes[rng.random(len(codes)) >= missing_fraction]
+        pd.DataFrame({
+            'subject': tested,
+            'answer': rng.uniform(0.4, 1.0, len(tested)),
+            'response_time': rng.uniform(0.5, 5.0, len(tested)),
+        }).to_csv(os.path.join(data_dir, file_name), index=False)
+
+
+def write_recommendations(path, per_task=4):
+    """Write a recommendations store with a few rows per task, some shared between tasks"""
+    rows = []
+    for i, task_name in enumerate(RECOMMENDATION_TASKS.values()):
+        for j in range(per_task):
+            # Every first recommendation is shared, so drop_duplicates has work to do
+            number = 0 if j == 0 else i * per_task + j
+            rows.append([task_name, f"Занятие {number}", '2 раза в неделю по 45 минут', f"Описание занятия {number}"])
+    columns = ['ЭКФ*', 'Рекомендация (занятие/курс)*', 'График освоения программы', 'Описание программы']
+    pd.DataFrame(rows, columns=columns).to_parquet(path)
+
+
+def generate_cohort(output_dir, n_subjects, seed=0):
+    """Write a complete synthetic set of pipeline inputs to output_dir/data"""
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(output_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    subs = list(range(1, n_subjects + 1))
+
+    write_roster(os.path.join(data_dir, 'список_7класс.xlsx'), subs, rng)
+    write_norm_table(os.path.join(data_dir, 'norm_var_7class.csv'), subs, rng)
+    write_test_tables(data_dir, subs, rng)
+    write_recommendations(os.path.join(data_dir, 'recommendations.parquet'))
+    return data_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate schema-faithful fake pipeline inputs")
+    parser.add_argument('output_dir', help="directory where data/ is created")
+    parser.add_argument('--subjects', '-n', type=int, default=30, help="cohort size (default: 30)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data_dir = generate_cohort(args.output_dir, args.subjects, args.seed)
+    print(f"Generated {args.subjects} subjects in {data_dir}")